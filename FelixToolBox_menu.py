@@ -10,7 +10,7 @@
 
 from PyQt5.QtWidgets import QAction, QMenu
 from PyQt5.QtGui import QIcon
-from qgis.core import QgsSettings
+from qgis.core import QgsSettings, QgsApplication
 import os
 from  .library import *
 from .ui import *
@@ -29,6 +29,16 @@ class felixtoolbox_menu:
             self.iface.addPluginToMenu("&Félix's toolbox", submenu.menuAction())
 
     def initGui(self):
+        #geocoding cache shared by the geocoding tools, stored in the QGIS profile
+        AddressSearch.cache = geocodingCache(os.path.join(QgsApplication.qgisSettingsDirPath(), 'FelixToolbox', 'geocoding_cache.sqlite'))
+        #offline BAN index, filled with the départements imported from the address2point tool, only created when it is first used
+        AddressSearch.local_ban_path = os.path.join(QgsApplication.qgisSettingsDirPath(), 'FelixToolbox', 'ban_local.sqlite')
+        #self-hosted Nominatim stored with the API keys, the public instance is used when empty
+        AddressSearch.nominatim_url = QgsSettings().value('FelixToolbox/NOMINATIM_URL', None) or None
+        #offline SIRENE stock stored with the API keys, the selection from coordinates uses the API when it is not imported
+        stock = offlineSireneStock(QgsSettings().value('FelixToolbox/SIRENE_STOCK_DIR', '') or '')
+        siretInPolygonFilteredByCoordinates.local_stock = stock if stock.exists() else None
+
         #main menu
         self.menu = QMenu("Félix's toolbox", self.iface.mainWindow().menuBar())
         self.iface.mainWindow().menuBar().insertMenu(self.iface.firstRightStandardMenu().menuAction(), self.menu)
@@ -15,16 +15,25 @@
         github               : https://github.com/EwStinky/FelixToolbox
  ***************************************************************************/
 """
+import os
+import math
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import requests
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from shapely.geometry import shape, polygon
-from shapely.ops import voronoi_diagram
+from shapely.ops import voronoi_diagram, unary_union
 from shapely.wkt import loads
 import time
-from .utilsLibrary import decorators
+from .utilsLibrary import decorators, usefullTools, rateLimiter
 
 class Isochrone_API_IGN:
+    parallel_union_threshold = 50000 #Below this amount of isochrones per cost value, the union stays on a single core (about 3.5 s for 50000 isochrones, starting the pool costs about 1 s)
+    parallel_union_chunk_size = 250 #Amount of isochrones unioned together by a worker in the first round of the tree reduction
+    api_limiter = rateLimiter(max_calls=5, period=1) #geopf.fr navigation services usage policy: 5 requests / second, shared with Itinerary_IGN_API.py
+
     def __init__(self, input_layer:gpd.GeoDataFrame, range_value:list[int], processingMode:int=0, resource:str='bdtopo-valhalla', costType:str="time", profile:str='car', direction:str='arrival', constraints:str=None, geometryFormat:str='geojson', distanceUnit:str='meter', timeUnit:str='minute', crs:str='EPSG:4326', voronoi_extend_layer=None,key:str=None):
         """Initializes the Isochrone_API_IGN_V2 class the input layer and the range value.
         Every other parameters are set to their default value but can be changed, they are regrouped in a list to be used in 
@@ -61,6 +70,7 @@ class Isochrone_API_IGN:
 
     @staticmethod
     @decorators.retryRequest(min_wait=1, wait_multiplier=2, max_retries=3)
+    @decorators.rateLimit(api_limiter)
     def request_IGN_isochrone_api(point:str , costValue:int, resource:str='bdtopo-valhalla', costType:str="time", profile:str='car', direction:str='arrival', constraints:str=None, geometryFormat:str='geojson', distanceUnit:str='meter', timeUnit:str='minute', crs:str='EPSG:4326') -> gpd.GeoDataFrame:
         """
         The function `request_IGN_isochrone_api` prepares the body parameters for the isochrone API request from IGN service.
@@ -111,7 +121,84 @@ class Isochrone_API_IGN:
         return gdf
     
     @staticmethod
-    def post_api_dissolve_processing(input_gdf:gpd.GeoDataFrame, range_value:list) -> gpd.GeoDataFrame:
+    def spatial_partition(geometries, chunk_size:int) -> list:
+        """Split an array of geometries into chunks of neighbouring geometries (sort-tile-recursive on the centroids):
+        the centroids are sorted by X into vertical slices, then each slice is sorted by Y and cut into chunks of chunk_size.
+        Unioning neighbouring isochrones together keeps the partial results compact.
+
+        Args:
+            geometries (GeometryArray): array of shapely geometries (gpd.GeoSeries.values).
+            chunk_size (int): maximum number of geometries per chunk.
+
+        Returns:
+            list[GeometryArray]: list of arrays of geometries, one per chunk.
+        """
+        centroids = gpd.GeoSeries(geometries).centroid
+        x, y = centroids.x.to_numpy(), centroids.y.to_numpy()
+        number_of_slices = math.ceil(math.sqrt(math.ceil(len(geometries) / chunk_size)))
+        chunks = []
+        for vertical_slice in np.array_split(np.argsort(x, kind='stable'), number_of_slices):
+            ordered_slice = vertical_slice[np.argsort(y[vertical_slice], kind='stable')]
+            chunks.extend(geometries[ordered_slice[i:i + chunk_size]] for i in range(0, len(ordered_slice), chunk_size))
+        return chunks
+
+    @staticmethod
+    def parallel_union(geometries, max_workers:int=None, chunk_size:int=None):
+        """Union a large set of geometries with a hierarchical tree reduction spread over a process pool.
+        The geometries are partitioned spatially (see spatial_partition()), each partition is unioned by a worker,
+        then the partial results are merged pairwise by the workers until a single geometry remains.
+        Geometries are exchanged with the workers as WKB buffers (shapely pickles its geometries as WKB).
+
+        It falls back to a single core unary_union when the input is small (see parallel_union_threshold), on a single CPU
+        or if no process pool can be started, for example when no python interpreter is found next to QGIS.
+
+        Args:
+            geometries (iterable): shapely geometries to union.
+            max_workers (int, optional): Number of processes of the pool. Defaults to None (number of CPUs).
+            chunk_size (int, optional): Number of geometries unioned by a worker in the first round. Defaults to parallel_union_chunk_size.
+
+        Returns:
+            shapely geometry: the union of all the input geometries.
+        """
+        geometries = gpd.GeoSeries(list(geometries))
+        geometries = geometries[~(geometries.isna() | geometries.is_empty)].values
+        chunk_size = chunk_size or Isochrone_API_IGN.parallel_union_chunk_size
+        if len(geometries) < Isochrone_API_IGN.parallel_union_threshold or max_workers == 1 or (os.cpu_count() or 1) <= 1:
+            return unary_union(geometries)
+        with usefullTools.processPoolContext() as context:
+            if context is None:
+                return unary_union(geometries)
+            try:
+                with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+                    partial_union = list(pool.map(unary_union, [list(chunk) for chunk in Isochrone_API_IGN.spatial_partition(geometries, chunk_size)]))
+                    while len(partial_union) > 1: #pairwise merge of the partial results, an odd one out waits for the next round
+                        merged = list(pool.map(unary_union, [partial_union[i:i + 2] for i in range(0, len(partial_union) - 1, 2)]))
+                        partial_union = merged + partial_union[len(merged) * 2:]
+                return partial_union[0]
+            except (BrokenProcessPool, OSError):
+                return unary_union(geometries)
+
+    @staticmethod
+    def dissolve_isochrones(gdf:gpd.GeoDataFrame, max_workers:int=None) -> gpd.GeoDataFrame:
+        """Equivalent of gdf.dissolve() that uses parallel_union() for the geometries when the GeoDataFrame
+        is large enough, the attributes keep the first value of each column like dissolve() does.
+
+        Args:
+            gdf (gpd.GeoDataFrame): isochrones sharing the same cost value.
+            max_workers (int, optional): Number of processes used by parallel_union(). Defaults to None (number of CPUs).
+
+        Returns:
+            gpd.GeoDataFrame: a GeoDataFrame of one row containing the union of the isochrones.
+        """
+        if len(gdf) < Isochrone_API_IGN.parallel_union_threshold:
+            return gdf.dissolve()
+        group = np.zeros(len(gdf), dtype="int64")
+        attributes = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).groupby(group).first()
+        union = gpd.GeoDataFrame({gdf.geometry.name: [Isochrone_API_IGN.parallel_union(gdf.geometry.values, max_workers)]}, geometry=gdf.geometry.name, crs=gdf.crs)
+        return union.join(attributes)
+
+    @staticmethod
+    def post_api_dissolve_processing(input_gdf:gpd.GeoDataFrame, range_value:list, max_workers:int=None) -> gpd.GeoDataFrame:
         """post_api_processing runs a bunch of processing on the isochrones output from the ORS API services.
         It dissolves the isochrones per time value and then calculates the difference between each layer 
         (layer x+1 - layer x).
@@ -119,12 +206,13 @@ class Isochrone_API_IGN:
         Args:
             input_gdf (gpd.GeoDataFrame): GeoDataFrames containing isochrones from the API request.
             range_value: list[int]: a list of integers representing the time/distance values for which the isochrones will be calculated
+            max_workers (int, optional): Number of processes used to union large sets of isochrones, see parallel_union(). Defaults to None (number of CPUs).
 
         Returns:
             A GeoDataFrame representing the merged isochrones after the difference of each layers.
             Three new columns are added to the gdf to represent the value used for each isochrone, the X and Y coordinates of the centroid of the isochrone. 
         """
-        dissolved_gdf=[input_gdf[input_gdf['costValue'] == y].dissolve() for y in range_value] #dissovle the layer per time value
+        dissolved_gdf=[Isochrone_API_IGN.dissolve_isochrones(input_gdf[input_gdf['costValue'] == y], max_workers) for y in range_value] #dissovle the layer per time value
         difference = []
         difference.append(dissolved_gdf[0])  #Append the first layer without processing
         for u in range(len(range_value) - 1): #Loop to get the difference between each layer
@@ -136,7 +224,7 @@ class Isochrone_API_IGN:
         return gdf
     
     @staticmethod
-    def post_api_voronoi_processing(input_gdf:gpd.GeoDataFrame, range_value:list, point_layer:gpd.GeoDataFrame, voronoi_extend_layer:polygon.Polygon=None, key_attribute:str=None) -> gpd.GeoDataFrame:
+    def post_api_voronoi_processing(input_gdf:gpd.GeoDataFrame, range_value:list, point_layer:gpd.GeoDataFrame, voronoi_extend_layer:polygon.Polygon=None, key_attribute:str=None, max_workers:int=None) -> gpd.GeoDataFrame:
         """
         Same as post_api_dissolve_processing but it clips the output with the voronoï polygons of the input points.
 
@@ -146,13 +234,14 @@ class Isochrone_API_IGN:
             point_layer (gpd.GeoDataFrame): GeoDataFrame representing the input point layer used to calculate the isochrones.
             voronoi_extend_layer (polygon.Polygon, optional): Polygon used to clip the voronoi's cells. If None, no clipping is applied. Defaults to None.
             key_attribute (str, optional): Name of the point_layer attribute to use as a key value in the output. If None, None values are assigned to the keyValue column.
+            max_workers (int, optional): Number of processes used to union large sets of isochrones, see parallel_union(). Defaults to None (number of CPUs).
 
         Returns:
             gdf_voronoi | gdf_voronoi_with_key (gpd.GeoDataFrame): A GeoDataFrame representing the merged isochrones after the difference of each layers and clipped with the voronoi's cells.
             If key_attribute is provided, the value 'keyValue' will be corresponding to the value of the attribute for the point from the isochrone has been calculated.
         """
         try:
-            dissolved_gdf=[input_gdf[input_gdf['costValue'] == y].dissolve() for y in range_value] 
+            dissolved_gdf=[Isochrone_API_IGN.dissolve_isochrones(input_gdf[input_gdf['costValue'] == y], max_workers) for y in range_value] 
             difference = []
             difference.append(dissolved_gdf[0])  
             for u in range(len(range_value) - 1): 
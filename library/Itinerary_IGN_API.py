@@ -8,24 +8,44 @@
         github               : https://github.com/EwStinky/FelixToolbox
  ***************************************************************************/
 """
+import math
+import numpy as np
 import geopandas as gpd
 import pandas as pd
-from typing import List
+from typing import List, Callable
 import requests
-from shapely.geometry import shape
+import shapely
+from shapely.geometry import shape, Point
+from shapely.ops import linemerge, substring
 from .utilsLibrary import decorators,usefullTools
 from .Isochrone_IGN_API import Isochrone_API_IGN
+from .Offline_Routing_OSM import offlineRoadGraph
 
 class ItineraireIGN:
-    def __init__(self, start:gpd.GeoDataFrame, processingMode:int, end:gpd.GeoDataFrame=None, primaryKey:str=None, maximalTime:int=0, orderColumn:str=None, groupByColumn:str=None, resource:str='bdtopo-osrm', intermediates:List[str]=None, profile:str='car', optimization:str='fastest', constraints:List[str]=None, geometryFormat:str='geojson', distanceUnit:str='meter', timeUnit:str='minute', crs:str='EPSG:4326', waysAttributes:List[str]=None,getSteps:str='false',getBbox:str='false') -> gpd.GeoDataFrame:
+    apiLimiter = Isochrone_API_IGN.api_limiter #the geopf.fr usage policy (5 requests / second) is shared by the isochrone and itinerary services
+    maximumSpeedByProfile = {'car':130, 'pedestrian':8} #Default maximum straight-line speed (km/h) used by reachableCandidates() for each profile
+    maxChainPoints = 25 #Maximum number of points (departure + intermediates + arrival) sent in one request by oneByOneItinerary() when chainRequest is True
+
+    def __init__(self, start:gpd.GeoDataFrame, processingMode:int, end:gpd.GeoDataFrame=None, primaryKey:str=None, maximalTime:int=0, orderColumn:str=None, groupByColumn:str=None, maxWorkers:int=1, chainRequest:bool=False, maximumSpeed:float=None, kNearest:int=3, oversampling:float=2, flowOutput:bool=False, flowWeight:str=None, onBatch:Callable=None, resource:str='bdtopo-osrm', intermediates:List[str]=None, profile:str='car', optimization:str='fastest', constraints:List[str]=None, geometryFormat:str='geojson', distanceUnit:str='meter', timeUnit:str='minute', crs:str='EPSG:4326', waysAttributes:List[str]=None,getSteps:str='false',getBbox:str='false') -> gpd.GeoDataFrame:
         """Init the class, see request_IGN_itineraire_api() and oneByOneItinerary() doc for the rest of the parameters.
 
         Args:
-            processingMode (int): Integer that signifies which processing mode to use for the output. '0': calculate itineraries for every arrival from every departure points ; '1': same as 1 but the potential arrivals are filtered by a selected maximum driving time from each departure points ; '2': Only one layer is selected and the itinerary is created using each points of the layer, the order and the divinding of itineraries is selected by the user.
+            processingMode (int): Integer that signifies which processing mode to use for the output. '0': calculate itineraries for every arrival from every departure points ; '1': same as 1 but the potential arrivals are filtered by a selected maximum driving time from each departure points ; '2': Only one layer is selected and the itinerary is created using each points of the layer, the order and the divinding of itineraries is selected by the user ; '3': same as 0 but only the duration and distance are kept, in an itineraryMatrix (self.matrix), self.output is then a pd.DataFrame with one row per pair ; '4': itineraries from each departure point towards its kNearest closest arrival points (by duration).
             start (gpd.GeoDataFrame): A GeoDataFrame containing the departure points for the itinerary.
             end (gpd.GeoDataFrame, optional): A GeoDataFrame containing the arrival points for the itinerary. Optional because if processingMode = 2 then no arrival layer is needed.
             primaryKey (str, optional): Field name of the 'start' selected layer which the values it contains will be used as primary key in the output, if None, no key is added. Defaults to None.
             maximalTime (int, optional): Maximal time in minutes chosen to reach any points from 'end' layer from each individual 'start' point. It is used to limit the amount of itineraries to create from the current 'start' point in process. When set to 0, it creates an itinerary for every 'end' points. Defaults to 0.
+            maxWorkers (int, optional): Maximum number of itinerary requests running at the same time for processingMode 0 and 1. The geopf.fr quota is respected whatever the value (see apiLimiter). Defaults to 1 (sequential requests).
+            chainRequest (bool, optional): Only for processingMode 2, see oneByOneItinerary(). Defaults to False.
+            kNearest (int, optional): Only for processingMode 4, number of itineraries kept for each departure point. Defaults to 3.
+            oversampling (float, optional): Only for processingMode 4, kNearest * oversampling arrival points closest in straight line are routed before keeping the kNearest fastest ones. Defaults to 2.
+            flowOutput (bool, optional): Not for processingMode 3, if True the output is the flow layer made by aggregateFlows() instead of the itineraries. Defaults to False.
+            flowWeight (str, optional): Field name of the 'start' layer summed as trip weight of each segment of the flow layer (e.g. a population), if None only the count is kept. Defaults to None.
+            onBatch (Callable, optional): Only for processingMode 0 and 1 without flowOutput, called with a gpd.GeoDataFrame of the itineraries completed since its
+                previous call, as soon as they arrive (see usefullTools.runConcurrently()). The itineraries are then not kept and self.output is an empty GeoDataFrame. Defaults to None.
+            resource (str, optional): see request_IGN_itineraire_json(). With 'osm-local', no itinerary API is used: the OSM roads around the points are downloaded
+                once and every itinerary, matrix or filter is computed locally, see offlineRoadGraph. Defaults to 'bdtopo-osrm'.
+            maximumSpeed (float, optional): Only for processingMode 1, maximum straight-line speed in km/h used to discard the arrival points that can't be reached within maximalTime before any request, see reachableCandidates(). Defaults to None (value of maximumSpeedByProfile for the profile).
         """
         self.processingMode=processingMode
         self.start=start
@@ -38,6 +58,14 @@ class ItineraireIGN:
         self.maximalTime=maximalTime
         self.orderColumn=orderColumn
         self.groupByColumn=groupByColumn
+        self.maxWorkers=maxWorkers
+        self.chainRequest=chainRequest
+        self.kNearest=kNearest
+        self.oversampling=oversampling
+        self.flowOutput=flowOutput
+        self.flowWeight=flowWeight
+        self.onBatch=onBatch
+        self.maximumSpeed=maximumSpeed if maximumSpeed else self.maximumSpeedByProfile.get(profile, self.maximumSpeedByProfile['car'])
         self.params={
             'resource':resource,
             'intermediates':intermediates,
@@ -52,16 +80,23 @@ class ItineraireIGN:
             'timeUnit':timeUnit,
             'crs':crs
         }
+        self.localGraph=offlineRoadGraph.fromGeoDataFrames([start, end], profile) if resource==offlineRoadGraph.resource else None
         try:
             self.output = self.main()
-            if not self.output.empty:
+            if self.processingMode==3:
+                self.matrix=self.output
+                self.output=self.matrix.to_dataframe()
+            elif self.flowOutput and not self.output.empty:
+                self.output=self.aggregateFlows(self.output, self.flowWeight).to_json()
+            elif not self.output.empty:
                 self.output=self.output.to_json()
         except RuntimeError as e:
             raise RuntimeError("An error occurred while processing the isochrone API request: {}".format(e))
 
     @staticmethod
     @decorators.retryRequest(min_wait=1, wait_multiplier=2, max_retries=5)
-    def request_IGN_itineraire_api(start:str, end:str, resource:str='bdtopo-osrm', intermediates:List[str]=None, profile:str='car', optimization:str='fastest', constraints:List[str]=None, geometryFormat:str='geojson', distanceUnit:str='meter', timeUnit:str='minute', crs:str='EPSG:4326', waysAttributes:List[str]=None,getSteps:str='false',getBbox:str='false') -> gpd.GeoDataFrame:
+    @decorators.rateLimit(apiLimiter)
+    def request_IGN_itineraire_json(start:str, end:str, resource:str='bdtopo-osrm', intermediates:List[str]=None, profile:str='car', optimization:str='fastest', constraints:List[str]=None, geometryFormat:str='geojson', distanceUnit:str='meter', timeUnit:str='minute', crs:str='EPSG:4326', waysAttributes:List[str]=None,getSteps:str='false',getBbox:str='false') -> dict:
         """Calculate a route by providing a starting point and a destination. 
         It use IGN's API: https://www.geoportail.gouv.fr/depot/swagger/itineraire.html#/Utilisation/routeItineraire-get
 
@@ -82,7 +117,7 @@ class ItineraireIGN:
             getBbox (str, optional): Presence of the route's Bbox in the response.. Defaults to 'false'.
 
         Returns:
-            gpd.GeoDataFrame: A geodata
+            dict: The decoded json response of the API.
         """
         api_headers  = {
             'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
@@ -106,11 +141,68 @@ class ItineraireIGN:
         }
         call=requests.get('https://data.geopf.fr/navigation/itineraire',params=api_body,headers=api_headers)
         call.raise_for_status()
-        gdf = gpd.GeoDataFrame([{'geometry': shape(call.json()['geometry']), **{k: v for k, v in call.json().items() if k != 'geometry'}}], geometry='geometry', crs='EPSG:4326')
+        return call.json()
+
+    @staticmethod
+    def request_IGN_itineraire_api(start:str, end:str, **kwargs) -> gpd.GeoDataFrame:
+        """Calculate a route between start and end with request_IGN_itineraire_json() (see its doc for the parameters)
+        and return it as a GeoDataFrame of one row containing the route's geometry and the attributes returned by the API.
+        """
+        output=ItineraireIGN.request_IGN_itineraire_json(start, end, **kwargs)
+        gdf = gpd.GeoDataFrame([{'geometry': shape(output['geometry']), **{k: v for k, v in output.items() if k != 'geometry'}}], geometry='geometry', crs='EPSG:4326')
         return gdf
+
+    @staticmethod
+    def request_IGN_itineraire_cost(start:str, end:str, **kwargs) -> tuple:
+        """Same as request_IGN_itineraire_api() but only keeps the duration and the distance of the route, the geometry
+        is asked as an encoded polyline (lighter than GeoJSON) and dropped as soon as the response is decoded.
+
+        Returns:
+            tuple: (duration, distance) in the timeUnit and distanceUnit of the request.
+        """
+        output=ItineraireIGN.request_IGN_itineraire_json(start, end, **{**kwargs, 'geometryFormat':'polyline', 'getSteps':'false'})
+        return output.get('duration'), output.get('distance')
     
     @staticmethod
-    def oneByOneItinerary(layer:gpd.GeoDataFrame, orderColumn:str, groupByColumn:str=None, itineraryApiParameters:dict={}) -> gpd.GeoDataFrame:
+    def splitItineraryByWaypoints(itinerary:gpd.GeoDataFrame, waypoints:List[str]) -> List[dict]:
+        """Split an itinerary requested with intermediates points into one section per pair of consecutive waypoints.
+        The distance and duration of each section come from the 'portions' returned by the API. The geometry of
+        a section is made from its steps when the API returned them (getSteps='true'), otherwise the itinerary is
+        cut where each waypoint is projected on it, moving forward along the line.
+
+        Args:
+            itinerary (gpd.GeoDataFrame): output of request_IGN_itineraire_api() with 'start', intermediates and 'end' equal to the waypoints.
+            waypoints (List[str]): Coordinates 'X,Y' of the departure, the intermediates points and the arrival, in this order.
+
+        Returns:
+            List[dict]: one dict per section containing the same keys as the itinerary.
+        """
+        route=itinerary.iloc[0]
+        line=route['geometry']
+        portions=route['portions'] if isinstance(route.get('portions'), list) else []
+        position=[0.0]
+        for waypoint in waypoints[1:-1]:
+            remaining=substring(line, position[-1], line.length)
+            position.append(position[-1]+remaining.project(Point(map(float, waypoint.split(',')))))
+        position.append(line.length)
+        sections=[]
+        for index in range(len(waypoints)-1):
+            portion=portions[index] if index<len(portions) else {}
+            step_geometries=[shape(step['geometry']) for step in portion.get('steps', []) if isinstance(step.get('geometry'), dict)]
+            section={key: value for key, value in route.items() if key!='geometry'}
+            section.update({
+                'geometry': linemerge(step_geometries) if step_geometries else substring(line, position[index], position[index+1]),
+                'start': waypoints[index],
+                'end': waypoints[index+1],
+                'distance': portion.get('distance'),
+                'duration': portion.get('duration'),
+                'portions': [portion]
+                })
+            sections.append(section)
+        return sections
+
+    @staticmethod
+    def oneByOneItinerary(layer:gpd.GeoDataFrame, orderColumn:str, groupByColumn:str=None, itineraryApiParameters:dict={}, chainRequest:bool=False, localGraph:offlineRoadGraph=None) -> gpd.GeoDataFrame:
         """Create itineraries between points that share a common value in a selected field (groupByColumn).
         The order of the itinerary is defined by sorting the value of the selected field (orderColumn).
         The idea is to create an itinerary from one layer without having to precise the departure or arrival,
@@ -126,6 +218,12 @@ class ItineraireIGN:
                 sharing the same values. Defaults to None.
             itineraryApiParameters (dict, optional): Dictionary containing all the optionals parameters allowed in
                 ItineraireIGN.request_IGN_itineraire_api(). Defaults to an empty dict
+            chainRequest (bool, optional): If True, each group is requested as a single itinerary using the points between
+                the first and the last one as 'intermediates' (in chunks of maxChainPoints points when the group is larger),
+                and the result is split back into one section per pair of consecutive points with splitItineraryByWaypoints().
+                The 'intermediates' from itineraryApiParameters are replaced by the points of the group. 
+                If False, one request is sent per pair of consecutive points. Defaults to False.
+            localGraph (offlineRoadGraph, optional): If set, the itineraries are computed with this graph instead of the API (chainRequest is ignored). Defaults to None.
 
         Returns:
             gpd.GeoDataFrame: A GeoDataFrame containing the itineraries, divided by group from groupByColumn's value 
@@ -138,21 +236,230 @@ class ItineraireIGN:
             list_gdf = [layer]
         list_itinerary=[]
         for gdf in list_gdf:
+            if len(gdf)<2:
+                continue
             if gdf.crs!="EPSG:4326":
                 gdf.to_crs("EPSG:4326",inplace=True)
-            for itinerary in range(len(gdf)-1):
-                itinerary_output=ItineraireIGN.request_IGN_itineraire_api(
-                    "{},{}".format(gdf.iloc[itinerary]['geometry'].x,gdf.iloc[itinerary]['geometry'].y),
-                    "{},{}".format(gdf.iloc[itinerary+1]['geometry'].x,gdf.iloc[itinerary+1]['geometry'].y),
+            coordinates=usefullTools.extractPointCoordinatesGdf(gdf)
+            orderValues=gdf[orderColumn].tolist()
+            groupValue=gdf[groupByColumn].iloc[0] if groupByColumn is not None else None
+            if localGraph is not None:
+                itinerary_output=localGraph.routePairs(coordinates[:-1], coordinates[1:], **itineraryApiParameters)
+            elif chainRequest:
+                sections=[]
+                for first in range(0, len(gdf)-1, ItineraireIGN.maxChainPoints-1): #consecutive chunks share their last/first point
+                    waypoints=coordinates[first:first+ItineraireIGN.maxChainPoints]
+                    chain_output=ItineraireIGN.request_IGN_itineraire_api(
+                        waypoints[0],
+                        waypoints[-1],
+                        **{**itineraryApiParameters, 'intermediates': '|'.join(waypoints[1:-1]) if len(waypoints)>2 else None}
+                        )
+                    sections.extend(ItineraireIGN.splitItineraryByWaypoints(chain_output, waypoints))
+                itinerary_output=gpd.GeoDataFrame(sections, geometry='geometry', crs='EPSG:4326')
+            else:
+                itinerary_output=gpd.GeoDataFrame(pd.concat([ItineraireIGN.request_IGN_itineraire_api(
+                    coordinates[itinerary],
+                    coordinates[itinerary+1],
                     **itineraryApiParameters
-                    )
-                itinerary_output['departure_{}'.format(orderColumn)]=gdf.iloc[itinerary][orderColumn]
-                itinerary_output['arrival_{}'.format(orderColumn)]=gdf.iloc[itinerary+1][orderColumn]
-                if groupByColumn is not None:
-                    itinerary_output[groupByColumn]=gdf.iloc[itinerary][groupByColumn]
-                list_itinerary.append(itinerary_output)
+                    ) for itinerary in range(len(gdf)-1)], ignore_index=True))
+            itinerary_output['departure_{}'.format(orderColumn)]=orderValues[:-1]
+            itinerary_output['arrival_{}'.format(orderColumn)]=orderValues[1:]
+            if groupByColumn is not None:
+                itinerary_output[groupByColumn]=groupValue
+            list_itinerary.append(itinerary_output)
         return gpd.GeoDataFrame(pd.concat(list_itinerary, ignore_index=True))
 
+    @staticmethod
+    def aggregateFlows(itineraries:gpd.GeoDataFrame, weightColumn:str=None, precision:float=1.0, mergeLines:bool=False) -> gpd.GeoDataFrame:
+        """Decompose the itineraries into the segments between their consecutive vertices and keep each segment once with the
+        number of itineraries using it. The itineraries of the same network share their vertices, so the segments are identified by
+        their end points rounded to precision (meters, EPSG:2154), in an undirected order, and counted with np.unique instead of overlaying the lines.
+
+        Args:
+            itineraries (gpd.GeoDataFrame): LineStrings (or MultiLineStrings) of the itineraries.
+            weightColumn (str, optional): Column of itineraries summed on each segment as trip weight. Defaults to None.
+            precision (float, optional): Precision in meters used to match the vertices of different itineraries. Defaults to 1.0.
+            mergeLines (bool, optional): If True, the contiguous segments sharing the same count and weight are merged into one line. Defaults to False.
+
+        Returns:
+            gpd.GeoDataFrame: one row per segment (or merged line) with its 'count' and the sum of weightColumn, in EPSG:4326.
+        """
+        itineraries=itineraries[itineraries.geometry.notna()&~itineraries.geometry.is_empty]
+        parts,route=shapely.get_parts(itineraries.to_crs(epsg=2154).geometry.values, return_index=True)
+        coordinates,part=shapely.get_coordinates(parts, return_index=True)
+        vertices=np.round(coordinates/precision).astype(np.int64)
+        isSegment=part[1:]==part[:-1]
+        first,second,route=vertices[:-1][isSegment],vertices[1:][isSegment],route[part[:-1][isSegment]]
+        swap=(first[:,0]>second[:,0])|((first[:,0]==second[:,0])&(first[:,1]>second[:,1])) #undirected: the smallest end point first
+        first[swap],second[swap]=second[swap],first[swap].copy()
+        keep=(first!=second).any(axis=1)
+        segments,segment=np.unique(np.hstack([first[keep],second[keep]]), axis=0, return_inverse=True)
+        segment,route=segment.ravel(),route[keep]
+        _,unique_use=np.unique(segment*len(itineraries)+route, return_index=True) #an itinerary using a segment twice counts once
+        segment,route=segment[unique_use],route[unique_use]
+        flows={'count':np.bincount(segment, minlength=len(segments))}
+        if weightColumn is not None:
+            weights=pd.to_numeric(itineraries[weightColumn], errors='coerce').fillna(0).to_numpy()
+            flows[weightColumn]=np.bincount(segment, weights=weights[route], minlength=len(segments))
+        output=gpd.GeoDataFrame(flows, geometry=shapely.linestrings(segments.reshape(-1,2,2)*precision), crs='EPSG:2154')
+        if mergeLines and len(output)>0:
+            output=output.dissolve(by=list(flows), as_index=False)
+            output['geometry']=shapely.line_merge(output.geometry.values)
+            output=output.explode(index_parts=False).reset_index(drop=True)
+        return output.to_crs(epsg=4326)
+
+    @staticmethod
+    def reachableCandidates(start_gdf:gpd.GeoDataFrame, end_gdf:gpd.GeoDataFrame, radius:float) -> list:
+        """Straight-line pre-filter of the arrival points: a KD-tree is built over the arrival points in a projected crs (EPSG:2154,
+        the IGN services only cover France) and queried at once with every departure point.
+
+        Args:
+            start_gdf (gpd.GeoDataFrame): departure points.
+            end_gdf (gpd.GeoDataFrame): arrival points.
+            radius (float): maximum straight-line distance in meters between a departure and an arrival point.
+
+        Returns:
+            list: for each departure point, a sorted np.ndarray of the positions (iloc) in end_gdf of the arrival points located within radius.
+                The array is empty when the departure point has no geometry or no arrival point is close enough.
+        """
+        startXY=usefullTools.pointCoordinatesArray(start_gdf.to_crs(epsg=2154))
+        endXY=usefullTools.pointCoordinatesArray(end_gdf.to_crs(epsg=2154))
+        validEnd=np.flatnonzero(~np.isnan(endXY).any(axis=1))
+        validStart=~np.isnan(startXY).any(axis=1)
+        candidates=[np.empty(0, dtype=int) for _ in range(len(start_gdf))]
+        if len(validEnd)==0 or not validStart.any():
+            return candidates
+        cKDTree=usefullTools.optionalImport('scipy.spatial', 'The straight-line pre-filter of the arrival points').cKDTree
+        neighbours=cKDTree(endXY[validEnd]).query_ball_point(startXY[validStart], r=radius)
+        for position,neighbour in zip(np.flatnonzero(validStart),neighbours):
+            candidates[position]=np.sort(validEnd[neighbour])
+        return candidates
+
+    @staticmethod
+    def nearestCandidates(start_gdf:gpd.GeoDataFrame, end_gdf:gpd.GeoDataFrame, k:int) -> list:
+        """Find the k closest arrival points in straight line of every departure point with a KD-tree built over the arrival points
+        in a projected crs (EPSG:2154), queried at once with every departure point.
+
+        Args:
+            start_gdf (gpd.GeoDataFrame): departure points.
+            end_gdf (gpd.GeoDataFrame): arrival points.
+            k (int): number of arrival points to find for each departure point.
+
+        Returns:
+            list: for each departure point, a np.ndarray of the positions (iloc) in end_gdf of its closest arrival points, from the closest to the furthest.
+                The array is empty when the departure point has no geometry.
+        """
+        startXY=usefullTools.pointCoordinatesArray(start_gdf.to_crs(epsg=2154))
+        endXY=usefullTools.pointCoordinatesArray(end_gdf.to_crs(epsg=2154))
+        validEnd=np.flatnonzero(~np.isnan(endXY).any(axis=1))
+        validStart=~np.isnan(startXY).any(axis=1)
+        candidates=[np.empty(0, dtype=int) for _ in range(len(start_gdf))]
+        k=min(k, len(validEnd))
+        if k==0 or not validStart.any():
+            return candidates
+        cKDTree=usefullTools.optionalImport('scipy.spatial', 'The search of the nearest arrival points').cKDTree
+        _,neighbours=cKDTree(endXY[validEnd]).query(startXY[validStart], k=k)
+        for position,neighbour in zip(np.flatnonzero(validStart),neighbours.reshape(-1,k)):
+            candidates[position]=validEnd[neighbour]
+        return candidates
+
+    def kNearestItineraries(self, start_gdf:gpd.GeoDataFrame, end_gdf:gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """Create the itineraries from each departure point towards its self.kNearest closest arrival points.
+        The self.kNearest * self.oversampling closest arrival points in straight line are routed (see nearestCandidates()),
+        then only the self.kNearest fastest itineraries according to the duration returned by the API are kept.
+        The amount of requests goes from len(start) * len(end) down to about len(start) * kNearest * oversampling.
+
+        Returns:
+            gpd.GeoDataFrame: the itineraries with the 'end_id' (index of the arrival point) and the 'rank' (1 = fastest) of each itinerary.
+        """
+        listCoordsStart=usefullTools.extractPointCoordinatesGdf(start_gdf)
+        listCoordsEnd=usefullTools.extractPointCoordinatesGdf(end_gdf)
+        listCandidates=self.nearestCandidates(start_gdf, end_gdf, math.ceil(self.kNearest*self.oversampling))
+        listPairs=[(index,listCoordsStart[index],listCoordsEnd[position]) for index,candidates in enumerate(listCandidates) for position in candidates]
+        list_gdf=self.routePairs(listPairs)
+        if len(list_gdf)==0:
+            return gpd.GeoDataFrame()
+        output=gpd.GeoDataFrame(pd.concat(list_gdf, ignore_index=True))
+        output['end_id']=[end_gdf.index[position] for candidates in listCandidates for position in candidates]
+        output['departure']=np.repeat(np.arange(len(listCandidates)), [len(candidates) for candidates in listCandidates])
+        output['rank']=output.groupby('departure')['duration'].rank(method='first').astype(int)
+        output=output[output['rank']<=self.kNearest].sort_values(['departure','rank'])
+        return gpd.GeoDataFrame(output.drop(columns='departure').reset_index(drop=True))
+
+    def routePairs(self, listPairs:list[tuple], onBatch:Callable=None) -> list[gpd.GeoDataFrame]:
+        """Request the itinerary of every pair of listPairs, with up to self.maxWorkers requests running at the same time.
+        Every request goes through apiLimiter so the parallelism stays within the geopf.fr quota.
+
+        Args:
+            listPairs (list[tuple]): list of (index of the departure point in self.start, departure coordinates 'X,Y', arrival coordinates 'X,Y').
+            onBatch (Callable, optional): if set, called with a gpd.GeoDataFrame of the itineraries completed since its previous call
+                and nothing is returned, see usefullTools.runConcurrently(). Defaults to None.
+
+        Returns:
+            list[gpd.GeoDataFrame]: the itineraries in the same order as listPairs, with the primary key of the departure point if self.primaryKey is set.
+        """
+        def addDepartureAttributes(index:int, gdf_itineraire:gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+            if self.primaryKey!=None:
+                gdf_itineraire['{}'.format(self.primaryKey)] = self.listPrimaryKey[index]
+            if self.flowWeight!=None:
+                gdf_itineraire['{}'.format(self.flowWeight)] = self.start[self.flowWeight].iloc[index]
+            return gdf_itineraire
+        batchCallback=(lambda batch: onBatch(gpd.GeoDataFrame(pd.concat(batch, ignore_index=True)))) if onBatch is not None else None
+        if self.localGraph is not None:
+            local_gdf=self.localGraph.routePairs([departure for _,departure,_ in listPairs], [arrival for _,_,arrival in listPairs], **self.params)
+            return usefullTools.runConcurrently(
+                lambda index,position: addDepartureAttributes(index, local_gdf.iloc[[position]].reset_index(drop=True)),
+                [(index,position) for position,(index,_,_) in enumerate(listPairs)],
+                onBatch=batchCallback,
+                batchSize=len(listPairs)) #computed locally: only flushed every flushInterval seconds
+        return usefullTools.runConcurrently(
+            lambda index,departure,arrival: addDepartureAttributes(index, self.request_IGN_itineraire_api(departure,arrival, **self.params)),
+            listPairs,
+            self.maxWorkers,
+            batchCallback)
+
+    def computeMatrix(self) -> 'itineraryMatrix':
+        """Request the duration and distance of the itinerary from every departure point (self.start) to every arrival point (self.end)
+        without keeping the geometries, see request_IGN_itineraire_cost(). Pairs that can't be requested (empty or non-point geometry) are left to NaN.
+
+        Returns:
+            itineraryMatrix: the durations and distances, the rows are the departure points and the columns the arrival points.
+        """
+        start_gdf=self.start.to_crs(epsg=4326) if self.start.crs!="EPSG:4326" else self.start
+        end_gdf=self.end.to_crs(epsg=4326) if self.end.crs!="EPSG:4326" else self.end
+        listCoordsStart=usefullTools.extractPointCoordinatesGdf(start_gdf)
+        listCoordsEnd=usefullTools.extractPointCoordinatesGdf(end_gdf)
+        if self.localGraph is not None:
+            durations,distances=self.localGraph.costMatrix(listCoordsStart, listCoordsEnd, **self.params)
+            return itineraryMatrix(
+                self.listPrimaryKey if self.listPrimaryKey!=None else self.start.index.tolist(),
+                self.end.index.tolist(),
+                listCoordsStart,
+                listCoordsEnd,
+                durations,
+                distances,
+                self.params,
+                self.localGraph)
+        listCells=[(row,column) for row,departure in enumerate(listCoordsStart) if departure!=None for column,arrival in enumerate(listCoordsEnd) if arrival!=None]
+        costs=usefullTools.runConcurrently(
+            lambda departure,arrival: self.request_IGN_itineraire_cost(departure,arrival, **self.params),
+            [(listCoordsStart[row],listCoordsEnd[column]) for row,column in listCells],
+            self.maxWorkers)
+        durations=np.full((len(listCoordsStart),len(listCoordsEnd)), np.nan)
+        distances=np.full((len(listCoordsStart),len(listCoordsEnd)), np.nan)
+        if len(listCells)>0:
+            rows,columns=np.array(listCells).T
+            durations[rows,columns]=np.array([cost[0] for cost in costs], dtype=float)
+            distances[rows,columns]=np.array([cost[1] for cost in costs], dtype=float)
+        return itineraryMatrix(
+            self.listPrimaryKey if self.listPrimaryKey!=None else self.start.index.tolist(),
+            self.end.index.tolist(),
+            listCoordsStart,
+            listCoordsEnd,
+            durations,
+            distances,
+            self.params)
+
     def main(self):
         """
         If processingMode = 0:
@@ -164,9 +471,18 @@ class ItineraireIGN:
         The arrivals points are then selected for the itinerary if they intersect the isochrone. 
         If maximalTime>0 but no arrival points are intersected, no itinerary is created and the current departure point is skipped.
         If maximalTime=0 it create an itinerary for each end point (no isochrone created, similar to processingMode = 1).
+        Before the isochrone, the arrival points further than self.maximumSpeed * maximalTime in straight line are discarded (see reachableCandidates()),
+        and the isochrone is not requested at all if no arrival point remains.
         The main goal is to limit the number of itineraries created when the number of departure/arrival is too high.
+        With the 'osm-local' resource, the arrival points are directly selected with the local graph (dijkstra stopped at maximalTime), without isochrone.
         One limit of the use of isochrones as filter is that sometimes the shape of the isochrone does not overlap one or several end points when they realistically should (isochrone having a small position error on where is located the road for example).
 
+        If processingMode = 3:
+        Same pairs as processingMode = 0 but only the durations and distances are kept, see computeMatrix().
+
+        If processingMode = 4:
+        Create the itineraries from each departure point towards its self.kNearest closest arrival points, see kNearestItineraries().
+
         If processingMode = 2: 
         Create a itineraries between points within one selected layer, following an order based on the sorting value of a selected column (self.orderColumn) of the input geodataframe.
         Several itineraries can be created if the user chose to group the differents points according to their values of a selected column. This results into several
@@ -174,29 +490,115 @@ class ItineraireIGN:
         Returns:
             gpd.GeoDataFrame: A geodataframe containing all the itinaries of each departure point towards the ends points
         """
+        if self.processingMode==3:
+            return self.computeMatrix()
+        if self.processingMode==4:
+            return self.kNearestItineraries(
+                self.start.to_crs(epsg=4326) if self.start.crs!="EPSG:4326" else self.start,
+                self.end.to_crs(epsg=4326) if self.end.crs!="EPSG:4326" else self.end)
         if self.processingMode!=2:
-            list_gdf=[]
-            list_intersected_end_points=None
+            listPairs=[] #(index of the departure point, departure coordinates, arrival coordinates) of every itinerary to request
             start_gdf=self.start.to_crs(epsg=4326) if self.start.crs!="EPSG:4326" else self.start
             end_gdf=self.end.to_crs(epsg=4326) if self.end.crs!="EPSG:4326" else self.end
-            if any([self.processingMode==0, self.maximalTime==0]):
-                listCoordsEnd = usefullTools.extractPointCoordinatesGdf(self.end)
+            listCoordsEnd = np.array(usefullTools.extractPointCoordinatesGdf(end_gdf), dtype=object)
+            filterByTime = all([isinstance(self.maximalTime, int),self.maximalTime!=0,self.processingMode==1])
+            if filterByTime and self.localGraph is not None: #the arrival points reached within maximalTime are found locally, no isochrone needed
+                durations,_=self.localGraph.costMatrix(usefullTools.extractPointCoordinatesGdf(start_gdf), listCoordsEnd.tolist(), **{**self.params, 'timeUnit':'second'}, maximalDuration=self.maximalTime*60)
+                listCandidates=[np.flatnonzero(~np.isnan(row)) for row in durations]
+            elif filterByTime: #arrival points further than maximumSpeed * maximalTime can't be reached, no need to ask an isochrone for them
+                listCandidates = self.reachableCandidates(start_gdf, end_gdf, self.maximumSpeed*1000/60*self.maximalTime)
+                endIndex = end_gdf.sindex #built once (STRtree) and queried with every isochrone
             for index,departure in enumerate(usefullTools.extractPointCoordinatesGdf(start_gdf)):
                 if departure==None: #Case when the geometry is empty or not a point.
-                    pass
-                if all([isinstance(self.maximalTime, int),self.maximalTime!=0,self.processingMode==1]):
-                    intersecred_end_points=gpd.sjoin(end_gdf,Isochrone_API_IGN.request_IGN_isochrone_api(departure,self.maximalTime),how='inner',predicate="intersects")
-                    if len(intersecred_end_points.index)==0:
-                        pass
-                    list_intersected_end_points=usefullTools.extractPointCoordinatesGdf(intersecred_end_points)
-                list_arrival=listCoordsEnd if any([self.processingMode==0, self.maximalTime==0]) else list_intersected_end_points
-                for arrival in list_arrival:
-                    gdf_itineraire = self.request_IGN_itineraire_api(departure,arrival, **self.params)
-                    if self.primaryKey!=None:
-                        gdf_itineraire['{}'.format(self.primaryKey)] = self.listPrimaryKey[index]
-                    list_gdf.append(gdf_itineraire)
+                    continue
+                if filterByTime and self.localGraph is not None:
+                    list_arrival=listCoordsEnd[listCandidates[index]]
+                elif filterByTime:
+                    if len(listCandidates[index])==0:
+                        continue
+                    isochrone=Isochrone_API_IGN.request_IGN_isochrone_api(departure,self.maximalTime).to_crs(end_gdf.crs)
+                    _,intersected_end_points=endIndex.query(isochrone.geometry.values, predicate="intersects")
+                    intersected_end_points=np.intersect1d(intersected_end_points, listCandidates[index])
+                    if len(intersected_end_points)==0:
+                        continue
+                    list_arrival=listCoordsEnd[intersected_end_points]
+                else:
+                    list_arrival=listCoordsEnd
+                listPairs.extend([(index,departure,arrival) for arrival in list_arrival if arrival!=None])
+            list_gdf=self.routePairs(listPairs, self.onBatch if not self.flowOutput else None)
             if len(list_gdf)==0:
                 return gpd.GeoDataFrame()
             return gpd.GeoDataFrame(pd.concat(list_gdf, ignore_index=True))
         else:
-            return ItineraireIGN.oneByOneItinerary(self.start, self.orderColumn, self.groupByColumn, self.params)
\ No newline at end of file
+            return ItineraireIGN.oneByOneItinerary(self.start, self.orderColumn, self.groupByColumn, self.params, self.chainRequest, self.localGraph)
+
+class itineraryMatrix:
+    """Durations and distances of the itineraries between every departure and arrival points, stored in two NumPy
+    matrices (rows: departure points, columns: arrival points) instead of one LineString per itinerary.
+    The geometry of an itinerary is only requested for the pairs asked with route()."""
+    def __init__(self, startIds:list, endIds:list, startCoords:List[str], endCoords:List[str], durations:np.ndarray, distances:np.ndarray, params:dict={}, localGraph:offlineRoadGraph=None):
+        """
+        Args:
+            startIds (list): id of each departure point (primary key or index), one per row of the matrices.
+            endIds (list): id of each arrival point (index), one per column of the matrices.
+            startCoords (List[str]): Coordinates 'X,Y' in WGS84 of each departure point.
+            endCoords (List[str]): Coordinates 'X,Y' in WGS84 of each arrival point.
+            durations (np.ndarray): Matrix of the durations, in the timeUnit of params.
+            distances (np.ndarray): Matrix of the distances, in the distanceUnit of params.
+            params (dict, optional): Parameters used for the requests, see ItineraireIGN.request_IGN_itineraire_json(). Defaults to {}.
+            localGraph (offlineRoadGraph, optional): Graph used to compute the matrices, route() uses it instead of the API when set. Defaults to None.
+        """
+        self.startIds=list(startIds)
+        self.endIds=list(endIds)
+        self.startCoords=startCoords
+        self.endCoords=endCoords
+        self.durations=durations
+        self.distances=distances
+        self.params=params
+        self.localGraph=localGraph
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Return the matrices as a pd.DataFrame with one row per pair (start_id, end_id, duration, distance), the pairs without result are dropped."""
+        rows,columns=np.nonzero(~np.isnan(self.durations))
+        return pd.DataFrame({
+            'start_id': np.asarray(self.startIds, dtype=object)[rows],
+            'end_id': np.asarray(self.endIds, dtype=object)[columns],
+            'duration': self.durations[rows,columns],
+            'distance': self.distances[rows,columns]
+            })
+
+    def to_csv(self, path:str, **kwargs):
+        """Export the matrix to a CSV file, one row per pair, see to_dataframe(). kwargs are passed to pd.DataFrame.to_csv()."""
+        self.to_dataframe().to_csv(path, index=False, **kwargs)
+
+    def to_parquet(self, path:str, **kwargs):
+        """Export the matrix to a Parquet file, one row per pair, see to_dataframe(). Requires pyarrow or fastparquet."""
+        self.to_dataframe().to_parquet(path, index=False, **kwargs)
+
+    def route(self, pairs:list[tuple], maxWorkers:int=1) -> gpd.GeoDataFrame:
+        """Request the itinerary's geometry only for the pairs selected by the user.
+
+        Args:
+            pairs (list[tuple]): list of (start_id, end_id).
+            maxWorkers (int, optional): Maximum number of requests running at the same time. Defaults to 1.
+
+        Returns:
+            gpd.GeoDataFrame: one itinerary per pair, with the start_id and end_id columns.
+        """
+        startPosition={value:index for index,value in enumerate(self.startIds)}
+        endPosition={value:index for index,value in enumerate(self.endIds)}
+        listPairs=[(self.startCoords[startPosition[start_id]],self.endCoords[endPosition[end_id]]) for start_id,end_id in pairs]
+        if self.localGraph is not None:
+            local_gdf=self.localGraph.routePairs([departure for departure,_ in listPairs], [arrival for _,arrival in listPairs], **self.params)
+            list_gdf=[local_gdf.iloc[[position]].reset_index(drop=True) for position in range(len(local_gdf))]
+        else:
+            list_gdf=usefullTools.runConcurrently(
+                lambda departure,arrival: ItineraireIGN.request_IGN_itineraire_api(departure,arrival, **self.params),
+                listPairs,
+                maxWorkers)
+        for (start_id,end_id),gdf in zip(pairs,list_gdf):
+            gdf['start_id']=start_id
+            gdf['end_id']=end_id
+        if len(list_gdf)==0:
+            return gpd.GeoDataFrame()
+        return gpd.GeoDataFrame(pd.concat(list_gdf, ignore_index=True))
@@ -0,0 +1,171 @@
+"""
+/***************************************************************************
+    Offline_Geocoding_BAN.py geocodes french addresses without any API,
+    with a local SQLite full-text index built from the BAN address dumps
+    published by adresse.data.gouv.fr.
+                             -------------------
+        start                : 2026-10-19
+        email                : felix.gardot@gmail.com
+        github               : https://github.com/EwStinky/FelixToolbox
+ ***************************************************************************/
+"""
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import requests
+from requests.exceptions import RequestException
+from .utilsLibrary import decorators
+from .address2point import geocodingCache
+
+class offlineBanGeocoder:
+    """
+    Local geocoder answering the same queries as AddressSearch.search_address_API_BAN() from a SQLite file.
+    Each département of the BAN (https://adresse.data.gouv.fr/data/ban/adresses/latest/csv/) is imported once
+    into a FTS5 table using the trigram tokenizer (SQLite >= 3.34), the labels being normalized like the
+    geocoding cache (see geocodingCache.normalize_address()). The candidates found by the index are then
+    scored by the similarity of their trigrams with the query, so the throughput only depends on the CPU.
+    """
+    dump_url = 'https://adresse.data.gouv.fr/data/ban/adresses/latest/csv/adresses-{}.csv.gz'
+    dump_columns = ['id', 'numero', 'rep', 'nom_voie', 'code_postal', 'code_insee', 'nom_commune', 'lon', 'lat']
+    stop_words = {'rue', 'avenue', 'boulevard', 'place', 'chemin', 'impasse', 'route', 'allee', 'de', 'des', 'du', 'la', 'le', 'les'}
+    max_candidates = 200 #candidates of the index scored for each query
+
+    @staticmethod
+    def is_supported() -> bool:
+        """True if the SQLite of this python has FTS5 and its trigram tokenizer (SQLite >= 3.34), checked in memory without creating any file."""
+        try:
+            with sqlite3.connect(':memory:') as connection:
+                connection.execute("CREATE VIRTUAL TABLE test USING fts5(label, tokenize='trigram')")
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    def __init__(self, path:str):
+        """Open (and create if needed) the SQLite file of the index.
+
+        Raises:
+            sqlite3.OperationalError: the SQLite of this python has no FTS5 trigram tokenizer (see is_supported()), no file is created.
+        """
+        if not self.is_supported():
+            raise sqlite3.OperationalError("The offline BAN index needs SQLite >= 3.34 with FTS5, found SQLite {}".format(sqlite3.sqlite_version))
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with sqlite3.connect(self.path) as connection:
+            connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS addresses USING fts5(
+                label, id UNINDEXED, housenumber UNINDEXED, street UNINDEXED, postcode UNINDEXED, citycode UNINDEXED,
+                city UNINDEXED, lon UNINDEXED, lat UNINDEXED, departement UNINDEXED, tokenize='trigram')""")
+            connection.execute("CREATE TABLE IF NOT EXISTS departements (departement TEXT PRIMARY KEY, addresses INTEGER)")
+            if connection.execute("SELECT 1 FROM departements LIMIT 1").fetchone() is None and connection.execute("SELECT 1 FROM addresses LIMIT 1").fetchone() is not None:
+                connection.execute("INSERT INTO departements SELECT departement, COUNT(*) FROM addresses GROUP BY departement") #index built before the departements table
+
+    def departements(self) -> list:
+        """Return the départements already imported, read from the departements table filled by import_departement()."""
+        with sqlite3.connect(self.path) as connection:
+            return [row[0] for row in connection.execute("SELECT departement FROM departements ORDER BY departement")]
+
+    @staticmethod
+    @decorators.retryRequest(min_wait=1,wait_multiplier=2,max_retries=5,exceptions=(RequestException))
+    def download_departement(departement:str, path:str) -> str:
+        """Download the BAN dump (csv.gz) of a département into path and return path."""
+        with requests.get(offlineBanGeocoder.dump_url.format(departement), stream=True) as call:
+            call.raise_for_status()
+            with open(path, 'wb') as file:
+                for block in call.iter_content(chunk_size=1024*1024):
+                    file.write(block)
+        return path
+
+    def import_departement(self, departement:str, csv_path:str=None, chunksize:int=100000) -> int:
+        """Import the addresses of a département in the index, replacing its previous import.
+
+        Args:
+            departement (str): code of the département ('01', '2A', '75', '974'...).
+            csv_path (str, optional): BAN dump already downloaded (csv or csv.gz), downloaded next to the index if None.
+            chunksize (int, optional): rows read and inserted at once. Defaults to 100000.
+
+        Returns:
+            int: number of addresses imported.
+        """
+        downloaded = csv_path is None
+        if downloaded:
+            csv_path = self.download_departement(departement, '{}_{}.csv.gz'.format(os.path.splitext(self.path)[0], departement))
+        count = 0
+        try:
+            with self.lock, sqlite3.connect(self.path) as connection:
+                connection.execute("DELETE FROM addresses WHERE departement = ?", (departement,))
+                for chunk in pd.read_csv(csv_path, sep=';', usecols=self.dump_columns, dtype=str, keep_default_na=False, chunksize=chunksize):
+                    housenumber = (chunk['numero'] + chunk['rep']).where(chunk['numero'] != '99999', '') #99999: address without number (lieu-dit)
+                    label = (housenumber + ' ' + chunk['nom_voie'] + ' ' + chunk['code_postal'] + ' ' + chunk['nom_commune']).str.strip()
+                    rows = pd.DataFrame({
+                        'label': label.map(geocodingCache.normalize_address),
+                        'id': chunk['id'], 'housenumber': housenumber, 'street': chunk['nom_voie'],
+                        'postcode': chunk['code_postal'], 'citycode': chunk['code_insee'], 'city': chunk['nom_commune'],
+                        'lon': pd.to_numeric(chunk['lon'], errors='coerce'), 'lat': pd.to_numeric(chunk['lat'], errors='coerce'),
+                        'departement': departement})
+                    connection.executemany("INSERT INTO addresses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows.itertuples(index=False, name=None))
+                    count += len(rows)
+                connection.execute("INSERT OR REPLACE INTO departements VALUES (?, ?)", (departement, count))
+        finally:
+            if downloaded and os.path.isfile(csv_path):
+                os.remove(csv_path)
+        return count
+
+    @staticmethod
+    def trigrams(text:str) -> set:
+        return {text[index:index+3] for index in range(max(len(text)-2, 1))}
+
+    def search(self, q:str, limit:int=5, autocomplete:int=0, citycode:str=None, postcode:str=None, type_search:str=None, lat:float=None, lon:float=None) -> gpd.GeoDataFrame:
+        """Search an address in the local index, with the parameters of AddressSearch.search_address_API_BAN() (autocomplete and type_search are ignored,
+        every entry of the index being a 'housenumber' or a 'locality').
+
+        Returns: a GeoDataFrame with the main properties of the API (label, score, housenumber, id, name, postcode, citycode, city, street, type),
+            sorted by score (0 to 1, trigram similarity with the query, lat/lon favour the closest addresses).
+
+        Raises:
+            ValueError: no address found, the message is the query (same as the API).
+        """
+        query = geocodingCache.normalize_address(q)
+        numbers = [word for word in query.split() if re.fullmatch(r'\d{1,4}[a-z]*', word)] #house numbers, postcodes have 5 digits
+        number = re.match(r'\d+', numbers[0]).group() if numbers else None
+        words = [word for word in query.split() if len(word) >= 3 and word not in numbers]
+        distinctive = [word for word in words if word not in self.stop_words] or words
+        if not distinctive:
+            raise ValueError(q)
+        filters, arguments = "", []
+        if citycode is not None:
+            filters += " AND citycode = ?"
+            arguments.append(str(citycode))
+        if postcode is not None:
+            filters += " AND postcode = ?"
+            arguments.append(str(postcode))
+        sql = "SELECT label, id, housenumber, street, postcode, citycode, city, lon, lat FROM addresses WHERE addresses MATCH ?{} ORDER BY rank LIMIT {}"
+        with sqlite3.connect(self.path) as connection:
+            for match in [' AND '.join('"{}"'.format(word) for word in distinctive), ' OR '.join('"{}"'.format(word) for word in distinctive)]: #every word, then any of them
+                candidates = []
+                if number is not None: #the addresses with the house number of the query first, a long street has more addresses than max_candidates
+                    candidates = connection.execute(sql.format(filters + " AND (housenumber = ? OR lower(housenumber) GLOB ?)", self.max_candidates),
+                        [match] + arguments + [number, number + '[a-z]*']).fetchall()
+                candidates += connection.execute(sql.format(filters, self.max_candidates), [match] + arguments).fetchall()
+                if candidates:
+                    break
+        if not candidates:
+            raise ValueError(q)
+        candidates = pd.DataFrame(candidates, columns=['label', 'id', 'housenumber', 'street', 'postcode', 'citycode', 'city', 'lon', 'lat']).drop_duplicates('id')
+        query_trigrams = self.trigrams(query)
+        candidates['score'] = [len(query_trigrams & self.trigrams(label)) / len(query_trigrams | self.trigrams(label)) for label in candidates['label']]
+        if lat is not None and lon is not None: #same idea as the API: the closest addresses are favoured
+            distance = np.hypot((candidates['lon'] - float(lon)) * np.cos(np.radians(float(lat))), candidates['lat'] - float(lat)) * 111.32 #km
+            candidates['score'] = candidates['score'] * 0.9 + 0.1 / (1 + distance)
+        candidates = candidates.sort_values('score', ascending=False, kind='stable').head(limit).reset_index(drop=True)
+        candidates['label'] = (candidates['housenumber'] + ' ' + candidates['street'] + ' ' + candidates['postcode'] + ' ' + candidates['city']).str.strip()
+        candidates['name'] = (candidates['housenumber'] + ' ' + candidates['street']).str.strip()
+        candidates['type'] = np.where(candidates['housenumber'] != '', 'housenumber', 'locality')
+        return gpd.GeoDataFrame(
+            candidates.drop(columns=['lon', 'lat']),
+            geometry=gpd.points_from_xy(candidates['lon'], candidates['lat']),
+            crs="EPSG:4326")
@@ -0,0 +1,278 @@
+"""
+/***************************************************************************
+    Offline_Routing_OSM.py builds a local road graph from the OpenStreetMap
+    network downloaded with the Overpass API and answers routing and
+    matrix queries without any itinerary API.
+                             -------------------
+        start                : 2026-10-19
+        email                : felix.gardot@gmail.com
+        github               : https://github.com/EwStinky/FelixToolbox
+ ***************************************************************************/
+"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from typing import List
+from pyproj import Transformer
+from shapely.geometry import LineString
+from .utilsLibrary import requestOtherApi, usefullTools
+
+class offlineRoadGraph:
+    """Road graph built from the OSM highways (see requestOtherApi.get_osm_road_within_bbox()), stored as two CSR matrices
+    (travel time in seconds and length in meters of each edge) and queried with scipy.sparse.csgraph.dijkstra.
+    The graph is built in EPSG:2154 (the tools of the plugin only cover France), the points are snapped on the closest node
+    of the largest strongly connected part of the network, the distance between a point and its node is not counted.
+    scipy is imported when a graph is built, so the plugin loads without it and only the 'osm-local' resource needs it."""
+    resource = 'osm-local' #Name of the resource in ItineraireIGN
+    speedByHighway = { #Default car speed (km/h) of each highway class when the road has no usable maxspeed tag
+        'motorway':110, 'motorway_link':60, 'trunk':90, 'trunk_link':50,
+        'primary':70, 'primary_link':40, 'secondary':60, 'secondary_link':40,
+        'tertiary':50, 'tertiary_link':30, 'unclassified':40, 'road':30,
+        'residential':30, 'living_street':10, 'service':20, 'track':15
+        }
+    maxspeedZones = {'FR:urban':50, 'FR:rural':80, 'FR:motorway':130, 'FR:zone30':30, 'FR:walk':6, 'walk':6}
+    pedestrianSpeed = 5 #km/h, used on every road open to pedestrians
+    pedestrianExcludedHighways = ['motorway', 'motorway_link', 'trunk', 'trunk_link']
+    precision = 0.1 #meters, coordinates are rounded to it to merge the vertices of the roads into nodes
+    batchCells = 5_000_000 #maximum number of cells (sources * nodes) of the arrays returned by one dijkstra call
+
+    def __init__(self, roads:gpd.GeoDataFrame, profile:str='car'):
+        """Build the graph, each segment between two consecutive vertices of a road is an edge.
+
+        Args:
+            roads (gpd.GeoDataFrame): LineStrings of the roads with the OSM tags as columns ('highway', optionally 'maxspeed', 'oneway', 'junction', 'access').
+            profile (str, optional): Displacement mode, 'car' or 'pedestrian'. Defaults to 'car'.
+        """
+        sparse,csgraph,spatial=self.scipyModules()
+        self.profile=profile
+        roads=self.filterRoads(roads, profile).to_crs(epsg=2154)
+        coordinates,line=shapely.get_coordinates(roads.geometry.values, return_index=True)
+        self.nodes,vertexNode=np.unique(np.round(coordinates/self.precision).astype(np.int64), axis=0, return_inverse=True)
+        self.nodes=self.nodes*self.precision
+        vertexNode=vertexNode.ravel()
+        isSegment=line[1:]==line[:-1] #consecutive vertices of the same road
+        u,v,line=vertexNode[:-1][isSegment],vertexNode[1:][isSegment],line[:-1][isSegment]
+        length=np.hypot(*(coordinates[1:][isSegment]-coordinates[:-1][isSegment]).T)
+        speed=self.roadSpeeds(roads, profile)[line]
+        forward,backward=self.roadDirections(roads, profile)
+        u,v,length,speed=(np.concatenate([u[forward[line]],v[backward[line]]]), np.concatenate([v[forward[line]],u[backward[line]]]),
+            np.concatenate([length[forward[line]],length[backward[line]]]), np.concatenate([speed[forward[line]],speed[backward[line]]]))
+        duration=length/(speed/3.6)
+        keep=u!=v
+        u,v,length,duration=u[keep],v[keep],length[keep],duration[keep]
+        order=np.lexsort((duration,v,u)) #parallel edges: only the fastest one is kept
+        u,v,length,duration=u[order],v[order],length[order],duration[order]
+        first=np.ones(len(u), dtype=bool)
+        first[1:]=(u[1:]!=u[:-1])|(v[1:]!=v[:-1])
+        shape=(len(self.nodes),len(self.nodes))
+        self.timeGraph=sparse.csr_matrix((duration[first],(u[first],v[first])), shape=shape)
+        self.lengthGraph=sparse.csr_matrix((length[first],(u[first],v[first])), shape=shape)
+        _,component=csgraph.connected_components(self.timeGraph, directed=True, connection='strong')
+        self.snapNodes=np.flatnonzero(component==np.bincount(component).argmax())
+        self.snapTree=spatial.cKDTree(self.nodes[self.snapNodes])
+        self.toProjected=Transformer.from_crs(4326, 2154, always_xy=True)
+        self.toWgs84=Transformer.from_crs(2154, 4326, always_xy=True)
+
+    @classmethod
+    def scipyModules(cls) -> tuple:
+        """Import the scipy modules used by the graph: (scipy.sparse, scipy.sparse.csgraph, scipy.spatial).
+
+        Raises:
+            ImportError: scipy is not installed, see usefullTools.optionalImport().
+        """
+        feature="The '{}' resource".format(cls.resource)
+        return tuple(usefullTools.optionalImport(module, feature) for module in ['scipy.sparse', 'scipy.sparse.csgraph', 'scipy.spatial'])
+
+    @classmethod
+    def fromBbox(cls, xmin:float, ymin:float, xmax:float, ymax:float, profile:str='car') -> 'offlineRoadGraph':
+        """Download the OSM roads located within the bbox (WGS84) and build the graph."""
+        cls.scipyModules() #fails before the download when scipy is missing
+        return cls(requestOtherApi.get_osm_road_within_bbox(xmin, ymin, xmax, ymax), profile)
+
+    @classmethod
+    def fromGeoDataFrames(cls, layers:List[gpd.GeoDataFrame], profile:str='car', margin:float=5000) -> 'offlineRoadGraph':
+        """Build the graph covering every layer of the list, with a margin in meters around their common extent
+        so the itineraries can leave the extent of the points."""
+        xmin,ymin,xmax,ymax=np.array([layer.to_crs(epsg=2154).total_bounds for layer in layers if layer is not None and not layer.empty]).T
+        bbox=gpd.GeoSeries([shapely.box(xmin.min()-margin, ymin.min()-margin, xmax.max()+margin, ymax.max()+margin)], crs=2154).to_crs(epsg=4326)
+        return cls.fromBbox(*bbox.total_bounds, profile)
+
+    @classmethod
+    def filterRoads(cls, roads:gpd.GeoDataFrame, profile:str) -> gpd.GeoDataFrame:
+        """Keep the LineStrings of the roads usable with the profile."""
+        highway=roads['highway'] if 'highway' in roads.columns else pd.Series(None, index=roads.index)
+        if profile=='pedestrian':
+            keep=highway.notna()&~highway.isin(cls.pedestrianExcludedHighways)
+        else:
+            keep=highway.isin(list(cls.speedByHighway))
+            if 'access' in roads.columns:
+                keep&=~roads['access'].isin(['no', 'private'])
+        return roads[keep.to_numpy()&(roads.geom_type=='LineString').to_numpy()]
+
+    @classmethod
+    def roadSpeeds(cls, roads:gpd.GeoDataFrame, profile:str) -> np.ndarray:
+        """Speed in km/h of each road: the maxspeed tag (numeric, mph or french zone) if usable, otherwise the default speed of its highway class."""
+        if profile=='pedestrian':
+            return np.full(len(roads), float(cls.pedestrianSpeed))
+        speed=roads['highway'].map(cls.speedByHighway).astype(float)
+        if 'maxspeed' in roads.columns:
+            maxspeed=roads['maxspeed'].astype(str)
+            tagged=pd.to_numeric(maxspeed.str.extract(r'(\d+(?:\.\d+)?)')[0], errors='coerce')
+            tagged=tagged.where(~maxspeed.str.contains('mph'), tagged*1.609).fillna(maxspeed.map(cls.maxspeedZones))
+            speed=tagged.where(tagged>0).fillna(speed)
+        return speed.to_numpy()
+
+    @staticmethod
+    def roadDirections(roads:gpd.GeoDataFrame, profile:str) -> tuple:
+        """Return two boolean arrays telling if each road can be used in the direction of its vertices (forward) and in the
+        opposite one (backward). The oneway tag is ignored for pedestrians, roundabouts and motorways are oneway by default."""
+        both=np.ones(len(roads), dtype=bool)
+        if profile=='pedestrian':
+            return both,both.copy()
+        oneway=roads['oneway'] if 'oneway' in roads.columns else pd.Series(None, index=roads.index, dtype=object)
+        implied=roads['highway'].eq('motorway')
+        if 'junction' in roads.columns:
+            implied|=roads['junction'].isin(['roundabout', 'circular'])
+        oneway=oneway.where(oneway.notna(), implied.map({True:'yes', False:'no'}))
+        forward=~oneway.isin(['-1', 'reverse']).to_numpy()
+        backward=~oneway.isin(['yes', 'true', '1']).to_numpy()
+        return forward,backward
+
+    def snap(self, coordinates:List[str]) -> np.ndarray:
+        """Return the closest node of each 'X,Y' WGS84 coordinates, -1 when the coordinates are None."""
+        points=np.array([list(map(float, point.split(','))) if point is not None else [np.nan, np.nan] for point in coordinates], dtype=float).reshape(-1,2)
+        nodes=np.full(len(points), -1)
+        valid=~np.isnan(points).any(axis=1)
+        if valid.any():
+            x,y=self.toProjected.transform(points[valid,0], points[valid,1])
+            nodes[valid]=self.snapNodes[self.snapTree.query(np.column_stack([x,y]))[1]]
+        return nodes
+
+    def weightGraphs(self, optimization:str) -> tuple:
+        """Return the graph minimized by the optimization ('fastest' or 'shortest') and the other one."""
+        return (self.lengthGraph,self.timeGraph) if optimization=='shortest' else (self.timeGraph,self.lengthGraph)
+
+    def shortestPathTrees(self, sources:np.ndarray, optimization:str='fastest', limit:float=np.inf):
+        """Run dijkstra from the sources by batches of at most batchCells cells.
+
+        Yields:
+            tuple: (sources of the batch, costs array (sources, nodes) with inf for unreachable nodes, predecessors array (sources, nodes)).
+        """
+        _,csgraph,_=self.scipyModules()
+        graph,_=self.weightGraphs(optimization)
+        batchSize=max(1, self.batchCells//max(1, len(self.nodes)))
+        for first in range(0, len(sources), batchSize):
+            batch=sources[first:first+batchSize]
+            costs,predecessors=csgraph.dijkstra(graph, directed=True, indices=batch, return_predecessors=True, limit=limit)
+            yield batch,costs,predecessors
+
+    def accumulate(self, predecessors:np.ndarray, graph:'scipy.sparse.csr_matrix') -> np.ndarray:
+        """Sum the weights of graph along the shortest path trees described by predecessors, using pointer jumping:
+        every iteration doubles the number of edges summed, so the loop runs log2(depth of the trees) times on whole arrays.
+
+        Returns:
+            np.ndarray: same shape as predecessors, the cost of the path from the source to each node.
+        """
+        rows,nodes=np.nonzero(predecessors>=0)
+        total=np.zeros((predecessors.shape[0], predecessors.shape[1]+1)) #last column: terminal pointer of the sources and unreachable nodes
+        total[rows,nodes]=np.asarray(graph[predecessors[rows,nodes], nodes]).ravel()
+        pointer=np.full(total.shape, predecessors.shape[1])
+        pointer[rows,nodes]=predecessors[rows,nodes]
+        terminal=predecessors.shape[1]
+        while (pointer[:,:-1]!=terminal).any():
+            total=total+np.take_along_axis(total, pointer, axis=1)
+            pointer=np.take_along_axis(pointer, pointer, axis=1)
+        return total[:,:-1]
+
+    @staticmethod
+    def convertUnits(durations:np.ndarray, distances:np.ndarray, timeUnit:str='minute', distanceUnit:str='meter') -> tuple:
+        """Convert durations in seconds and distances in meters to the units of the IGN API ('standard' times are given in minutes)."""
+        durations=durations/{'second':1, 'hour':3600}.get(timeUnit, 60)
+        distances=distances/1000 if distanceUnit=='kilometer' else distances
+        return durations,distances
+
+    def costMatrix(self, departures:List[str], arrivals:List[str], optimization:str='fastest', timeUnit:str='minute', distanceUnit:str='meter', maximalDuration:float=None, **kwargs) -> tuple:
+        """Duration and distance of the shortest path from every departure to every arrival.
+
+        Args:
+            departures (List[str]): 'X,Y' WGS84 coordinates of the departure points (None for a missing point).
+            arrivals (List[str]): 'X,Y' WGS84 coordinates of the arrival points (None for a missing point).
+            optimization (str, optional): 'fastest' or 'shortest'. Defaults to 'fastest'.
+            timeUnit (str, optional): Unit of the durations, see convertUnits(). Defaults to 'minute'.
+            distanceUnit (str, optional): Unit of the distances, meter or kilometer. Defaults to 'meter'.
+            maximalDuration (float, optional): Maximal duration in seconds, the search stops beyond it when optimization is 'fastest'
+                and the further arrivals are left to NaN. Defaults to None (no limit).
+            kwargs: other ItineraireIGN parameters, ignored.
+
+        Returns:
+            tuple: (durations, distances) np.ndarray of shape (departures, arrivals), NaN when no path exists.
+        """
+        startNodes,endNodes=self.snap(departures),self.snap(arrivals)
+        durations=np.full((len(startNodes),len(endNodes)), np.nan)
+        distances=np.full((len(startNodes),len(endNodes)), np.nan)
+        validEnd=np.flatnonzero(endNodes>=0)
+        sources,inverse=np.unique(startNodes[startNodes>=0], return_inverse=True)
+        limit=maximalDuration if maximalDuration is not None and optimization!='shortest' else np.inf
+        sourceDurations,sourceDistances=np.empty((len(sources),len(validEnd))),np.empty((len(sources),len(validEnd)))
+        position=0
+        for batch,costs,predecessors in self.shortestPathTrees(sources, optimization, limit):
+            other=self.accumulate(predecessors, self.weightGraphs(optimization)[1])[:,endNodes[validEnd]]
+            costs=costs[:,endNodes[validEnd]]
+            other[np.isinf(costs)]=np.nan
+            costs[np.isinf(costs)]=np.nan
+            sourceDurations[position:position+len(batch)],sourceDistances[position:position+len(batch)]=(other,costs) if optimization=='shortest' else (costs,other)
+            position+=len(batch)
+        if maximalDuration is not None:
+            sourceDistances[~(sourceDurations<=maximalDuration)]=np.nan
+            sourceDurations[~(sourceDurations<=maximalDuration)]=np.nan
+        rows=np.flatnonzero(startNodes>=0)
+        durations[np.ix_(rows,validEnd)]=sourceDurations[inverse]
+        distances[np.ix_(rows,validEnd)]=sourceDistances[inverse]
+        return self.convertUnits(durations, distances, timeUnit, distanceUnit)
+
+    def routePairs(self, departures:List[str], arrivals:List[str], optimization:str='fastest', timeUnit:str='minute', distanceUnit:str='meter', **kwargs) -> gpd.GeoDataFrame:
+        """Shortest path of each (departure, arrival) pair, the pairs sharing a departure point use the same dijkstra tree.
+
+        Args:
+            departures (List[str]): 'X,Y' WGS84 coordinates of the departure of each pair.
+            arrivals (List[str]): 'X,Y' WGS84 coordinates of the arrival of each pair.
+            kwargs: other ItineraireIGN parameters, ignored. See costMatrix() for the others.
+
+        Returns:
+            gpd.GeoDataFrame: one row per pair in the same order, with the same main attributes as the IGN API (start, end, distance, duration...).
+                The geometry is None and the costs NaN when no path exists.
+        """
+        startNodes,endNodes=self.snap(departures),self.snap(arrivals)
+        paths=[None]*len(startNodes)
+        sources=np.unique(startNodes[(startNodes>=0)&(endNodes>=0)])
+        for batch,_,predecessors in self.shortestPathTrees(sources, optimization):
+            row={node:index for index,node in enumerate(batch)}
+            for pair in np.flatnonzero(np.isin(startNodes, batch)&(endNodes>=0)):
+                tree=predecessors[row[startNodes[pair]]]
+                path=[endNodes[pair]]
+                while path[-1]!=startNodes[pair] and tree[path[-1]]>=0:
+                    path.append(tree[path[-1]])
+                if path[-1]==startNodes[pair]:
+                    paths[pair]=np.array(path[::-1])
+        durations=np.array([self.timeGraph[path[:-1],path[1:]].sum() if path is not None else np.nan for path in paths], dtype=float)
+        distances=np.array([self.lengthGraph[path[:-1],path[1:]].sum() if path is not None else np.nan for path in paths], dtype=float)
+        durations,distances=self.convertUnits(durations, distances, timeUnit, distanceUnit)
+        geometries=[]
+        for path in paths:
+            if path is None or len(path)<2:
+                geometries.append(None)
+                continue
+            x,y=self.toWgs84.transform(self.nodes[path,0], self.nodes[path,1])
+            geometries.append(LineString(np.column_stack([x,y])))
+        return gpd.GeoDataFrame({
+            'start':departures,
+            'end':arrivals,
+            'distance':distances,
+            'duration':durations,
+            'resource':self.resource,
+            'profile':self.profile,
+            'optimization':optimization,
+            'distanceUnit':distanceUnit,
+            'timeUnit':timeUnit
+            }, geometry=geometries, crs='EPSG:4326')
@@ -0,0 +1,141 @@
+"""
+/***************************************************************************
+    Offline_SIRENE_stock.py answers the SIRENE selections by coordinates
+    without the API, from the establishments stock published by INSEE
+    converted once into a Parquet dataset partitioned on a grid.
+                             -------------------
+        start                : 2026-10-19
+        email                : felix.gardot@gmail.com
+        github               : https://github.com/EwStinky/FelixToolbox
+ ***************************************************************************/
+"""
+import os
+import numpy as np
+import pandas as pd
+
+class offlineSireneStock:
+    """
+    Local copy of the SIRENE establishments stock (StockEtablissement, https://www.data.gouv.fr/fr/datasets/base-sirene-des-entreprises-et-de-leurs-etablissements-siren-siret/)
+    stored as a Parquet dataset (pyarrow needed) in a directory:
+        - one partition per tile of tile_size meters of the Lambert 93 coordinates (tile=<x>_<y>), the rows being sorted by coordinates
+          so that the statistics of the row groups skip most of a tile when only a part of it is requested.
+        - compact dtypes: siren and siret as integers, coordinates as float32 (less than 1 m of rounding), the other fields as strings
+          (dictionary encoded by parquet), written with the same schema for every chunk so the fragments can be read together.
+    The establishments without coordinates are not kept, they cannot be selected by coordinates.
+    Only the stored_columns of the CSV are imported, the other fields requested (the fields of the legal unit ...UniteLegale
+    are not in the stock of establishments) are returned empty.
+    """
+    tile_size = 50000 #meters
+    chunksize = 200000 #rows of the CSV converted at once
+    stored_columns = ['siren', 'siret', 'dateCreationEtablissement', 'trancheEffectifsEtablissement', 'anneeEffectifsEtablissement',
+        'activitePrincipaleRegistreMetiersEtablissement', 'etablissementSiege', 'complementAdresseEtablissement', 'numeroVoieEtablissement',
+        'indiceRepetitionEtablissement', 'typeVoieEtablissement', 'libelleVoieEtablissement', 'codePostalEtablissement', 'libelleCommuneEtablissement',
+        'codeCommuneEtablissement', 'codeCedexEtablissement', 'libelleCedexEtablissement', 'coordonneeLambertAbscisseEtablissement',
+        'coordonneeLambertOrdonneeEtablissement', 'dateDebut', 'etatAdministratifEtablissement', 'enseigne1Etablissement',
+        'denominationUsuelleEtablissement', 'activitePrincipaleEtablissement', 'nomenclatureActivitePrincipaleEtablissement',
+        'caractereEmployeurEtablissement']
+    integer_columns = {'siren': 9, 'siret': 14} #{column: number of digits}, written back as zero padded strings
+    coordinate_columns = ['coordonneeLambertAbscisseEtablissement', 'coordonneeLambertOrdonneeEtablissement']
+
+    def __init__(self, directory:str):
+        self.directory = directory
+
+    def exists(self) -> bool:
+        """True if a stock was already imported in the directory."""
+        return os.path.isdir(self.directory) and any(name.startswith('tile=') for name in os.listdir(self.directory))
+
+    @staticmethod
+    def tile(x, y) -> np.ndarray:
+        """Tile (partition) of Lambert 93 coordinates, as '<x>_<y>' strings."""
+        x = np.floor_divide(np.asarray(x, dtype=float), offlineSireneStock.tile_size).astype(int).astype(str)
+        y = np.floor_divide(np.asarray(y, dtype=float), offlineSireneStock.tile_size).astype(int).astype(str)
+        return np.char.add(np.char.add(x, '_'), y)
+
+    def import_stock(self, csv_path:str, columns:list=None) -> int:
+        """Convert the CSV of the stock (StockEtablissement_utf8.csv, or its zip) into the Parquet dataset of the directory,
+        replacing the previous import. The file is read by chunks of chunksize rows, only the columns stored are read.
+
+        Args:
+            csv_path (str): path of the CSV (or zip) of the stock.
+            columns (list, optional): columns of the CSV stored, the coordinates are always stored. Defaults to None (stored_columns).
+
+        Returns:
+            int: number of establishments imported.
+        """
+        if self.exists():
+            for root, directories, files in os.walk(self.directory, topdown=False):
+                for name in files:
+                    os.remove(os.path.join(root, name))
+                for name in directories:
+                    os.rmdir(os.path.join(root, name))
+        os.makedirs(self.directory, exist_ok=True)
+        count = 0
+        columns = set(columns or self.stored_columns) | set(self.coordinate_columns)
+        for chunk in pd.read_csv(csv_path, dtype=str, usecols=lambda column: column in columns, chunksize=self.chunksize):
+            x = pd.to_numeric(chunk[self.coordinate_columns[0]], errors='coerce')
+            y = pd.to_numeric(chunk[self.coordinate_columns[1]], errors='coerce')
+            chunk = chunk[(x.notna() & y.notna()).to_numpy()]
+            if chunk.empty:
+                continue
+            chunk[self.coordinate_columns[0]] = x[x.notna() & y.notna()].astype('float32').to_numpy()
+            chunk[self.coordinate_columns[1]] = y[x.notna() & y.notna()].astype('float32').to_numpy()
+            for column in self.integer_columns:
+                if column in chunk.columns:
+                    chunk[column] = pd.to_numeric(chunk[column], errors='coerce').astype('Int64')
+            chunk['tile'] = self.tile(chunk[self.coordinate_columns[0]], chunk[self.coordinate_columns[1]])
+            chunk = chunk.sort_values(['tile', self.coordinate_columns[0], self.coordinate_columns[1]])
+            chunk.to_parquet(self.directory, engine='pyarrow', partition_cols=['tile'], index=False, row_group_size=50000, schema=self.schema(chunk.columns))
+            count += len(chunk)
+        return count
+
+    def establishments_in_bbox(self, xmin:float, ymin:float, xmax:float, ymax:float, champs:list, activity:list[str]=[], active_only:bool=True) -> pd.DataFrame:
+        """Establishments of the stock located within a bounding box, same selection as siretInPolygonFilteredByCoordinates.etablissements_SIRENE_in_bbox().
+        Only the tiles intersecting the bounding box and the columns requested are read.
+
+        Args:
+            xmin, ymin, xmax, ymax (float): bounding box, EPSG:2154.
+            champs (list): columns returned, in this order, followed by the coordinates if they are not requested.
+            activity (list, optional): NAF codes (or their beginning) of activitePrincipaleEtablissement to keep. Defaults to [] (every activity).
+            active_only (bool, optional): keep only the establishments with etatAdministratifEtablissement 'A'. Defaults to True.
+
+        Returns:
+            pd.DataFrame: one row per establishment with the champs columns, siren and siret as strings like the API, coordinates as float.
+        """
+        tiles_x = range(int(xmin // self.tile_size), int(xmax // self.tile_size) + 1)
+        tiles_y = range(int(ymin // self.tile_size), int(ymax // self.tile_size) + 1)
+        tiles = [tile for tile in ('{}_{}'.format(x, y) for x in tiles_x for y in tiles_y) if os.path.isdir(os.path.join(self.directory, 'tile={}'.format(tile)))]
+        champs = list(dict.fromkeys(list(champs) + self.coordinate_columns))
+        if not tiles:
+            return pd.DataFrame(columns=champs)
+        filters = [
+            ('tile', 'in', tiles),
+            (self.coordinate_columns[0], '>=', xmin), (self.coordinate_columns[0], '<=', xmax),
+            (self.coordinate_columns[1], '>=', ymin), (self.coordinate_columns[1], '<=', ymax)]
+        if active_only:
+            filters.append(('etatAdministratifEtablissement', '==', 'A'))
+        available = self.columns()
+        columns = list(dict.fromkeys([column for column in champs if column in available] + self.coordinate_columns + (['activitePrincipaleEtablissement'] if activity else [])))
+        df = pd.read_parquet(self.directory, engine='pyarrow', columns=columns, filters=filters)
+        if activity:
+            naf = df['activitePrincipaleEtablissement'].astype(object)
+            df = df[naf.str.startswith(tuple(str(code) for code in activity), na=False).to_numpy()]
+        df = df.reset_index(drop=True)
+        for column, digits in self.integer_columns.items():
+            if column in df.columns:
+                df[column] = df[column].astype(object).map(lambda value: str(int(value)).zfill(digits) if pd.notna(value) else None)
+        output = pd.DataFrame({column: df[column].astype(object) if column in df.columns else None for column in champs}, index=df.index)
+        for column in self.coordinate_columns:
+            if column in output.columns:
+                output[column] = df[column].astype(float).to_numpy()
+        return output
+
+    def schema(self, columns:list):
+        """Arrow schema of the chunks written by import_stock(): the types inferred from each chunk would differ (a column empty in a chunk...)."""
+        import pyarrow #only needed by the offline stock, the plugin loads without pyarrow
+        return pyarrow.schema([(column, pyarrow.int64() if column in self.integer_columns else pyarrow.float32() if column in self.coordinate_columns else pyarrow.string())
+            for column in columns])
+
+    def columns(self) -> list:
+        """Columns of the stock imported."""
+        import pyarrow.parquet #only needed by the offline stock, the plugin loads without pyarrow
+        return pyarrow.parquet.ParquetDataset(self.directory).schema.names
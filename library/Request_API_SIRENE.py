@@ -10,17 +10,28 @@
         github               : https://github.com/EwStinky/FelixToolbox
  ***************************************************************************/
 """
+import heapq
+import logging
+import itertools
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import geopandas as gpd
 from requests.exceptions import RequestException
 from shapely.geometry import mapping, box
-from .utilsLibrary import decorators, requestOtherApi
+from shapely.prepared import prep
+from .utilsLibrary import decorators, requestOtherApi, usefullTools, rateLimiter
 from .address2point import AddressSearch
 
+logger = logging.getLogger(__name__)
+
 class apiSireneRequest:
     """Class to interact with the SIRENE API for retrieving information about French businesses and establishments."""
+    limiter = rateLimiter(max_calls=30, period=60) #usage policy of the API, shared by every request of every thread
+    max_workers = 4 #independent queries (e.g. one per bounding box) running at the same time, all within the limiter
+    max_page_size = 1000 #maximum 'nombre' allowed by the API, used by the cursor pagination
+
     def __init__(self,api_key,q=None,date=None,champs=None,masquerValeursNulles='false',facette=None,tri=None,nombre=20,debut=0,curseur='*'):
         """see get_request_api_SIRENE() for more details on the parameters."""
         self.api_key = api_key
@@ -37,12 +48,14 @@ class apiSireneRequest:
             }
 
     @decorators.retryRequest(min_wait=4,wait_multiplier=2,max_retries=5,exceptions=(RequestException))
-    def get_request_api_SIRENE(self) -> requests.Response:
+    @decorators.rateLimit(limiter)
+    def get_request_api_SIRENE(self, parameters:dict=None) -> requests.Response:
         """get_document_info will return the output of the request to the SIREN API based on the parameters provided.
         check the documentation for more details on the parameters: https://www.sirene.fr/static-resources/documentation/sommaire_311.html
-        Usage policy: 30 requests per minute.
+        Usage policy: 30 requests per minute (apiSireneRequest.limiter).
 
         Args:
+            parameters (dict, optional): parameters of the request, self.parameters if None. Given by the queries running concurrently.
             api_key (str): API key for authentication.
             q (str): Contents of multi-criteria query, see documentation for details.
             date (str, optional): Date at which historical data values are to be obtained. Defaults to None.
@@ -67,7 +80,7 @@ class apiSireneRequest:
             "X-INSEE-Api-Key-Integration": self.api_key
         }
         try:
-            call = requests.get(url, params=self.parameters,headers=headers)
+            call = requests.get(url, params=self.parameters if parameters is None else parameters,headers=headers)
             call.raise_for_status()
             return call
         except requests.exceptions.HTTPError as e:
@@ -78,34 +91,42 @@ class apiSireneRequest:
             else:
                 raise e
       
-    def get_request_with_cursor(self) -> pd.DataFrame:
+    def get_request_with_cursor(self, parameters:dict=None) -> pd.DataFrame:
         """Execute a request API with a cursor based on the parameters set up by the user.
         the request is executed until every results are gathered from the API.
+        The pages of one query are requested one after the other with the largest page size (max_page_size), the cursor is kept
+        in a copy of the parameters so several queries can run at the same time. The next page is requested as soon as the cursor
+        of the current one is known, the current page being read while the next one is downloaded.
 
         Args:
-            self.parameters (dict): dictionary containing all the parameters needed for get_request_api_SIRENE()
+            parameters (dict, optional): dictionary containing all the parameters needed for get_request_api_SIRENE(), self.parameters if None.
 
         Returns:
             pd.DataFrame: pd.DataFrame containing all the siret corresponding to the conditions used for the request.
         """
         try:
-            df = pd.DataFrame(columns=self.parameters['champs'].split(','))
-            if self.parameters['curseur'] != '*':
-                self.parameters['curseur'] = '*'
-            output = self.get_request_api_SIRENE()
+            parameters = dict(self.parameters if parameters is None else parameters)
+            columns = parameters['champs'].split(',')
+            df = pd.DataFrame(columns=columns)
+            records = [] #one dict per establishment, the DataFrame is only built once every page is read
+            extractor = sireneFieldExtractor(columns)
+            parameters['curseur'] = '*'
+            parameters['nombre'] = self.max_page_size
+            output = self.get_request_api_SIRENE(parameters)
             if output is None:
                 pass
             else:
-                if output.json()['header']['total'] > self.parameters['nombre']:
-                    while self.parameters['curseur'] != output.json()['header']['curseurSuivant']:
-                        for value in [dict for dict in output.json()['etablissements']]:
-                            df = pd.concat([df,pd.DataFrame({k:[v] for k,v in apiSireneUtils.find_values_in_json(value,df).items()})], ignore_index=True)
-                        self.parameters['curseur'] = output.json()['header']['curseurSuivant']
-                        output = self.get_request_api_SIRENE()
+                page = output.json() #each page is decoded once
+                if page['header']['total'] > parameters['nombre']:
+                    with ThreadPoolExecutor(max_workers=1) as prefetch:
+                        while parameters['curseur'] != page['header']['curseurSuivant']:
+                            parameters['curseur'] = page['header']['curseurSuivant']
+                            next_page = prefetch.submit(lambda parameters: self.get_request_api_SIRENE(parameters).json(), dict(parameters))
+                            records.extend(map(extractor.extract, page['etablissements']))
+                            page = next_page.result()
                 else:
-                    for value in [dict for dict in output.json()['etablissements']]:
-                        df = pd.concat([df,pd.DataFrame({k:[v] for k,v in apiSireneUtils.find_values_in_json(value,df).items()})], ignore_index=True)
-            return df
+                    records.extend(map(extractor.extract, page['etablissements']))
+            return pd.DataFrame(records, columns=columns, dtype=object) if records else df #object columns, as the DataFrame built row by row
         except Exception as e:
             raise e
 
@@ -158,6 +179,52 @@ class apiSireneUtils:
         else:
             return q[:q.find("periode(")+8]+'activitePrincipaleEtablissement:{}* AND '.format(*activity)+q[q.find("periode(")+8:]
     
+    @staticmethod
+    def quadtree_tiles(polygon, coverage_threshold:float=0.5, max_depth:int=3, min_size:float=500, max_tiles:int=16) -> list:
+        """Split the bounding box of a polygon into quadtree tiles until the polygon covers at least coverage_threshold of each tile,
+        so a thin or diagonal polygon is requested with several small boxes instead of one box mostly outside of it.
+        The tiles not intersecting the polygon are dropped. The least covered tile is split first, and a tile is no longer split
+        when its quarters would exceed max_tiles, each tile costing at least one request.
+
+        Args:
+            polygon (shapely geometry): polygon to cover, in a projected crs (EPSG:2154).
+            coverage_threshold (float, optional): ratio of the area of a tile inside the polygon above which the tile is kept whole. Defaults to 0.5.
+            max_depth (int, optional): maximum number of splits of a tile. Defaults to 3.
+            min_size (float, optional): tiles smaller than this width or height (in meters) are not split. Defaults to 500.
+            max_tiles (int, optional): maximum number of tiles returned. Defaults to 16.
+
+        Returns:
+            list: (minx, miny, maxx, maxy, inside) of each tile, inside is True when the tile is entirely within the polygon.
+        """
+        prepared = prep(polygon)
+        tiles = []
+        to_split = [] #heap of (coverage, order, bounds, depth) of the tiles that may still be split, least covered first
+        order = itertools.count() #ties broken by creation order
+        def add(minx, miny, maxx, maxy, depth):
+            tile = box(minx, miny, maxx, maxy)
+            if not prepared.intersects(tile):
+                return
+            if prepared.contains(tile):
+                tiles.append((minx, miny, maxx, maxy, True))
+                return
+            coverage = polygon.intersection(tile).area / tile.area
+            if depth >= max_depth or maxx - minx < min_size or maxy - miny < min_size or coverage >= coverage_threshold:
+                tiles.append((minx, miny, maxx, maxy, False))
+                return
+            heapq.heappush(to_split, (coverage, next(order), (minx, miny, maxx, maxy), depth))
+        add(*polygon.bounds, 0)
+        while to_split:
+            _, _, (minx, miny, maxx, maxy), depth = heapq.heappop(to_split)
+            midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+            quarters = [quarter for quarter in [(minx, miny, midx, midy), (midx, miny, maxx, midy), (minx, midy, midx, maxy), (midx, midy, maxx, maxy)]
+                if prepared.intersects(box(*quarter))]
+            if len(tiles) + len(to_split) + len(quarters) > max_tiles: #over the budget, the tile is requested whole
+                tiles.append((minx, miny, maxx, maxy, False))
+                continue
+            for quarter in quarters:
+                add(*quarter, depth + 1)
+        return tiles
+
     @staticmethod    
     def gdf_bbox_to_geojson(gdf:gpd.GeoDataFrame) -> dict:
         """Convert a GeoDataFrame to a GeoJSON representation of its bounding box."""
@@ -200,9 +267,62 @@ class apiSireneUtils:
         merge_gdf_no_duplicate = merge_gdf.drop_duplicates(['siret','siren'])
         return merge_gdf_no_duplicate
 
+class sireneFieldExtractor:
+    """Extract the values of the fields requested (champs) from the establishments returned by the SIRENE API, with the same result
+    as apiSireneUtils.find_values_in_json() (first value of each field in a depth-first walk of the json) without searching every record.
+    The access path of each field (keys and list indexes) is compiled from the first record holding every field, the establishments of a query sharing
+    the same layout, and only compiled again when following a path fails on a record (missing key, shorter list or null object)."""
+    def __init__(self, columns:list):
+        self.columns = set(columns)
+        self.paths = None #{column: path}
+
+    def compile(self, record:dict) -> dict:
+        """Path of the first value of each column found in record, in the order of find_values_in_json()."""
+        paths = {}
+        def walk(node, path):
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    if key in self.columns and key not in paths:
+                        paths[key] = path + (key,)
+                    walk(value, path + (key,))
+            elif isinstance(node, list):
+                for index, item in enumerate(node):
+                    walk(item, path + (index,))
+        walk(record, ())
+        return paths
+
+    @staticmethod
+    def follow(record:dict, paths:dict) -> dict:
+        """Values of record at the compiled paths, raises KeyError, IndexError or TypeError when record does not have this layout."""
+        result = {}
+        for column, path in paths.items():
+            value = record
+            for step in path:
+                value = value[step]
+            result[column] = value
+        return result
+
+    def extract(self, record:dict) -> dict:
+        """Return {column: value} for the columns found in record, same output as apiSireneUtils.find_values_in_json(record, df)."""
+        if self.paths is not None:
+            try:
+                return self.follow(record, self.paths)
+            except (KeyError, IndexError, TypeError):
+                pass
+        paths = self.compile(record)
+        if len(paths) == len(self.columns): #a record without some field (null object, empty list) cannot tell where the next ones have it
+            self.paths = paths
+        return self.follow(record, paths)
+
 class siretInPolygonFilteredByCoordinates(apiSireneRequest):
     """Selection from coordinates of the siret located within the polygons uses as gdf.
-    It faster than the selection by address but less accurate because not every siret has coordinates"""
+    It faster than the selection by address but less accurate because not every siret has coordinates.
+    When local_stock is set, the bounding boxes are answered by this offlineSireneStock instead of the API."""
+    local_stock = None #offlineSireneStock set by the plugin when a stock was imported
+    coverage_threshold = 0.5 #see apiSireneUtils.quadtree_tiles()
+    max_depth = 3
+    max_tiles = 16 #bounding boxes requested per polygon (shared between its parts), at least one request each within apiSireneRequest.limiter
+
     def __init__(self,polygon:gpd.GeoDataFrame,params:dict,activity:list[str]=[]):
         super().__init__(**params)
         self.gdf=polygon
@@ -223,20 +343,24 @@ class siretInPolygonFilteredByCoordinates(apiSireneRequest):
         Returns:
             pd.DataFrame: DataFrame containing the establishments within the bounding box.
         """
-        self.parameters['q'] = 'coordonneeLambertAbscisseEtablissement:[{} TO {}] AND coordonneeLambertOrdonneeEtablissement:[{} TO {}] AND periode(etatAdministratifEtablissement:A)'.format(xmin,xmax,ymin,ymax)
+        if self.local_stock is not None: #no request, the same selection from the stock imported
+            return self.local_stock.establishments_in_bbox(xmin, ymin, xmax, ymax, self.parameters['champs'].split(','), self.activity)
+        parameters = dict(self.parameters) #local, the bounding boxes are requested at the same time
+        parameters['q'] = 'coordonneeLambertAbscisseEtablissement:[{} TO {}] AND coordonneeLambertOrdonneeEtablissement:[{} TO {}] AND periode(etatAdministratifEtablissement:A)'.format(xmin,xmax,ymin,ymax)
         if len(self.activity)>0:
-            self.parameters['q']=apiSireneUtils.addFilterActivity(self.parameters['q'],self.activity)
+            parameters['q']=apiSireneUtils.addFilterActivity(parameters['q'],self.activity)
         try:
-            df_output=self.get_request_with_cursor()
+            df_output=self.get_request_with_cursor(parameters)
             return df_output
         except Exception as e:
-            raise f"Failed to retrieve data for {xmin},{ymin},{xmax},{ymax} : {e}"
+            raise RuntimeError(f"Failed to retrieve data for {xmin},{ymin},{xmax},{ymax} : {e}")
         
     
     def establishments_SIRENE_in_polygon_coordinates(self) -> gpd.GeoDataFrame:
         """ Function to retrieve establishments within the polygon defined by the GeoDataFrame's geometry.
-        Uses the bounding box of the polygon to query the SIRENE API for establishments, and check if
-        the establishments' coordinates intersect with the polygon's geometry.
+        Each part of the polygon is covered by quadtree tiles (see apiSireneUtils.quadtree_tiles()), the SIRENE API is queried
+        for each tile and the establishments' coordinates are checked against the polygon's geometry,
+        except for the tiles entirely within the polygon.
 
         Returns:
             output: pd.DataFrame: DataFrame containing the establishments within the polygon used as input.
@@ -250,16 +374,23 @@ class siretInPolygonFilteredByCoordinates(apiSireneRequest):
                 unique_gdf = gpd.GeoDataFrame(geometry=list(merged_geometry.geoms), crs="EPSG:2154") #multiple geometries
             else:
                 unique_gdf = gpd.GeoDataFrame(geometry=[merged_geometry], crs="EPSG:2154")
-            unique_gdf['bounds'] = unique_gdf.geometry.apply(lambda geom: list(geom.bounds))
-            unique_gdf[['minx', 'miny', 'maxx', 'maxy']] = unique_gdf['bounds'].apply(pd.Series)
+            max_tiles = max(1, self.max_tiles // len(unique_gdf)) #per part
+            tiles = [(minx, miny, maxx, maxy, inside, geometry) for geometry in unique_gdf.geometry
+                for minx, miny, maxx, maxy, inside in apiSireneUtils.quadtree_tiles(geometry, self.coverage_threshold, self.max_depth, max_tiles=max_tiles)]
+            if self.local_stock is None:
+                logger.info("SIRENE selection from coordinates: %d bounding boxes for %d polygon parts, at least %d requests (about %.1f minutes at %d requests per %d s)",
+                    len(tiles), len(unique_gdf), len(tiles), len(tiles) / self.limiter.max_calls * self.limiter.period / 60, self.limiter.max_calls, self.limiter.period)
 
-            for index, row in unique_gdf.iterrows():
-                output_api_df=self.etablissements_SIRENE_in_bbox(xmin=row['minx'],ymin=row['miny'],xmax=row['maxx'],ymax=row['maxy'])
+            outputs_api_df=usefullTools.runConcurrently( #the cursor of each tile is followed in its own thread, every request within apiSireneRequest.limiter
+                self.etablissements_SIRENE_in_bbox,
+                [tile[:4] for tile in tiles],
+                self.max_workers)
+            for (minx, miny, maxx, maxy, inside, geometry), output_api_df in zip(tiles, outputs_api_df):
                 output_api_gdf = gpd.GeoDataFrame(
                     output_api_df,
                     geometry=gpd.points_from_xy(output_api_df['coordonneeLambertAbscisseEtablissement'], output_api_df['coordonneeLambertOrdonneeEtablissement'], crs='EPSG:2154'),
                     crs='EPSG:2154')
-                clipped_points = output_api_gdf.clip(row['geometry'])
+                clipped_points = output_api_gdf if inside else output_api_gdf.clip(geometry) #a tile within the polygon needs no clipping
                 if not clipped_points.empty:
                     output = pd.concat([output, clipped_points], ignore_index=True)
             output.set_geometry('geometry', inplace=True, crs='EPSG:2154')
@@ -291,13 +422,14 @@ class siretInPolygonFilteredByAddresses(apiSireneRequest):
         Returns:
             pd.DataFrame: DataFrame containing the SIRENE establishments matching the criteria. And containing the columns specified in params['champs']
         """
-        self.parameters['q'] = f'codeCommuneEtablissement:{CityCode} AND typeVoieEtablissement:"{TypeStreet}" AND libelleVoieEtablissement:"{NameStreet}" AND periode(etatAdministratifEtablissement:A)'
+        parameters = dict(self.parameters)
+        parameters['q'] = f'codeCommuneEtablissement:{CityCode} AND typeVoieEtablissement:"{TypeStreet}" AND libelleVoieEtablissement:"{NameStreet}" AND periode(etatAdministratifEtablissement:A)'
         if len(self.activity)>0:
-            self.parameters['q']=apiSireneUtils.addFilterActivity(self.parameters['q'],self.activity)
+            parameters['q']=apiSireneUtils.addFilterActivity(parameters['q'],self.activity)
         try:
-            df_output=self.get_request_with_cursor()
+            df_output=self.get_request_with_cursor(parameters)
         except Exception as e:
-            raise f"Failed to retrieve data for typeVoieEtablissement:{TypeStreet}, libelleVoieEtablissement:{NameStreet}, codeCommuneEtablissement:{CityCode} : {e}"
+            raise RuntimeError(f"Failed to retrieve data for typeVoieEtablissement:{TypeStreet}, libelleVoieEtablissement:{NameStreet}, codeCommuneEtablissement:{CityCode} : {e}")
         return df_output
 
     def establishments_SIRENE_in_polygon_address(self) -> gpd.GeoDataFrame:
@@ -372,10 +504,10 @@ class siretInPolygonFilteredByAddresses(apiSireneRequest):
                 if not any([pd.isna(row_s['coordonneeLambertAbscisseEtablissement']),pd.isna(row_s['coordonneeLambertOrdonneeEtablissement'])]):
                     continue
                 else:
-                    geocodingAddress=AddressSearch.search_address_API_BAN(
-                        q=f"{row_s['numeroVoieEtablissement']}{row_s['indiceRepetitionEtablissement'] if not pd.isna(row_s['indiceRepetitionEtablissement']) else ''} {row_s['typeVoieEtablissement']} {row_s['libelleVoieEtablissement']}, {row_s['codePostalEtablissement']} {row_s['libelleCommuneEtablissement']}",
-                        limit=1,
-                        citycode=row_s['codeCommuneEtablissement'])
+                    geocodingAddress=AddressSearch.cached_search('BAN', { #the addresses already geocoded by any tool are taken from AddressSearch.cache
+                        'q':f"{row_s['numeroVoieEtablissement']}{row_s['indiceRepetitionEtablissement'] if not pd.isna(row_s['indiceRepetitionEtablissement']) else ''} {row_s['typeVoieEtablissement']} {row_s['libelleVoieEtablissement']}, {row_s['codePostalEtablissement']} {row_s['libelleCommuneEtablissement']}",
+                        'limit':1,
+                        'citycode':row_s['codeCommuneEtablissement']})
                     if not geocodingAddress.empty:
                         geocodingAddress.to_crs("EPSG:2154", inplace=True)
                         output_request_sirene.loc[index_s,'coordonneeLambertAbscisseEtablissement'] = geocodingAddress.geometry.x.iloc[0]
@@ -403,7 +535,7 @@ if __name__ == "__main__":
     params={
     "api_key":'', #Add your api-key here!
     "champs": 'siren,dateCreationUniteLegale,siret,dateCreationEtablissement,trancheEffectifsEtablissement,enseigne1Etablissement,codeCommuneEtablissement,numeroVoieEtablissement,typeVoieEtablissement,libelleVoieEtablissement,codePostalEtablissement,libelleCommuneEtablissement,activitePrincipaleEtablissement,etatAdministratifEtablissement,coordonneeLambertAbscisseEtablissement,coordonneeLambertOrdonneeEtablissement',
-    "nombre": 100,
+    "nombre": 1000,
     "curseur": '*',
     "date": '2099-01-01'
     }
@@ -11,6 +11,7 @@ __version__ = '1.0.0'
 __all__ = ['mapscreenshot',
            'Isochrone_API_ORS',
            'AddressSearch',
+           'geocodingCache',
            'Isochrone_API_IGN', 
            'apiSireneRequest', 
            'apiSireneUtils', 
@@ -19,13 +20,21 @@ __all__ = ['mapscreenshot',
            'decorators', 
            'requestOtherApi',
            'usefullTools',
-           'ItineraireIGN'
+           'rateLimiter',
+           'ItineraireIGN',
+           'itineraryMatrix',
+           'offlineRoadGraph',
+           'offlineBanGeocoder',
+           'offlineSireneStock'
            ]
 
 from .mapscreenshot import mapscreenshot
 from .Isochrone_ORS_Tools_GeopandasV3 import Isochrone_API_ORS
 from .Isochrone_IGN_API import Isochrone_API_IGN
-from .address2point import AddressSearch
+from .address2point import AddressSearch, geocodingCache
 from .Request_API_SIRENE import apiSireneRequest, apiSireneUtils, siretInPolygonFilteredByCoordinates, siretInPolygonFilteredByAddresses
-from .utilsLibrary import decorators, requestOtherApi, usefullTools
-from .Itinerary_IGN_API import ItineraireIGN
\ No newline at end of file
+from .utilsLibrary import decorators, requestOtherApi, usefullTools, rateLimiter
+from .Itinerary_IGN_API import ItineraireIGN, itineraryMatrix
+from .Offline_Routing_OSM import offlineRoadGraph
+from .Offline_Geocoding_BAN import offlineBanGeocoder
+from .Offline_SIRENE_stock import offlineSireneStock
@@ -9,10 +9,94 @@
         github               : https://github.com/EwStinky/FelixToolbox
  ***************************************************************************/
 """
+import io
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+import unicodedata
+import numpy as np
+import pandas as pd
 import geopandas as gpd
 import requests
 from requests.exceptions import RequestException
-from .utilsLibrary import decorators
+from .utilsLibrary import decorators, usefullTools, rateLimiter
+
+class geocodingCache:
+    """
+    Persistent cache of geocoding results stored in a SQLite file, shared by every tool geocoding addresses.
+    The key of a result is the API, the normalized address (see normalize_address()) and the other parameters of the request,
+    so the same address written differently ('12 Av. Jean Jaurès' / '12 avenue jean jaures') is only geocoded once.
+    The whole result is stored as GeoJSON with the score of its first feature.
+    """
+    street_types = { #abbreviations of the french street types, replaced by the full word
+        'r':'rue', 'av':'avenue', 'ave':'avenue', 'bd':'boulevard', 'bld':'boulevard', 'boul':'boulevard', 'pl':'place',
+        'ch':'chemin', 'che':'chemin', 'chem':'chemin', 'imp':'impasse', 'rte':'route', 'all':'allee', 'crs':'cours',
+        'fg':'faubourg', 'fbg':'faubourg', 'qu':'quai', 'sq':'square', 'pass':'passage', 'prom':'promenade', 'res':'residence',
+        'lot':'lotissement', 'sen':'sente', 'st':'saint', 'ste':'sainte'
+        }
+
+    def __init__(self, path:str):
+        """Open (and create if needed) the SQLite file of the cache."""
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with sqlite3.connect(self.path) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS geocoding (key TEXT PRIMARY KEY, api TEXT, address TEXT, result TEXT, score REAL, created REAL)")
+
+    @staticmethod
+    def normalize_address(address:str) -> str:
+        """Case fold the address, strip its accents and punctuation, collapse the whitespaces and write the street types in full."""
+        address = unicodedata.normalize('NFKD', str(address)).encode('ascii', 'ignore').decode('ascii').casefold()
+        words = re.sub(r"[^0-9a-z]+", ' ', address).split()
+        return ' '.join(geocodingCache.street_types.get(word, word) for word in words)
+
+    @staticmethod
+    def cache_key(api:str, address:str, parameters:dict={}) -> str:
+        """Key of a request: API, normalized address and the other parameters (without the address 'q')."""
+        filters = {key: value for key, value in parameters.items() if key != 'q' and value is not None}
+        return json.dumps([api, geocodingCache.normalize_address(address), filters], sort_keys=True, default=str)
+
+    def get_many(self, keys:list) -> dict:
+        """Return the cached results of the keys found in the cache, as {key: gpd.GeoDataFrame}."""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock, sqlite3.connect(self.path) as connection:
+            for first in range(0, len(unique_keys), 500): #SQLite limits the number of variables of a query
+                chunk = unique_keys[first:first+500]
+                rows = connection.execute("SELECT key, result FROM geocoding WHERE key IN ({})".format(','.join('?'*len(chunk))), chunk).fetchall()
+                for key, result in rows:
+                    found[key] = gpd.GeoDataFrame.from_features(json.loads(result)['features'], crs="EPSG:4326")
+        return found
+
+    def put_many(self, items:list):
+        """Store a list of (key, api, address, result) in the cache, replacing the previous results of the same keys.
+        A result is a gpd.GeoDataFrame or a GeoJSON FeatureCollection as dict."""
+        rows = []
+        for key, api, address, result in items:
+            features = json.loads(result.to_json())['features'] if isinstance(result, gpd.GeoDataFrame) else result['features']
+            properties = features[0]['properties'] if len(features) > 0 else {}
+            score = next((properties[column] for column in ['score', 'result_score', 'importance'] if properties.get(column) is not None), None)
+            score = pd.to_numeric(score, errors='coerce') if score is not None else None
+            rows.append((key, api, address, json.dumps({'type': 'FeatureCollection', 'features': features}), None if pd.isna(score) else float(score), time.time()))
+        with self.lock, sqlite3.connect(self.path) as connection:
+            connection.executemany("INSERT OR REPLACE INTO geocoding VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def get(self, api:str, address:str, parameters:dict={}) -> gpd.GeoDataFrame:
+        """Return the cached result of a request or None."""
+        return self.get_many([self.cache_key(api, address, parameters)]).get(self.cache_key(api, address, parameters))
+
+    def put(self, api:str, address:str, parameters:dict, result:gpd.GeoDataFrame):
+        """Store the result of a request."""
+        self.put_many([(self.cache_key(api, address, parameters), api, address, result)])
+
+    def clear(self):
+        """Remove every cached result."""
+        with self.lock, sqlite3.connect(self.path) as connection:
+            connection.execute("DELETE FROM geocoding")
 
 class AddressSearch:
     """
@@ -20,20 +104,77 @@ class AddressSearch:
     GeoDataFrame from an address string used as input
 
     /!\ The usage policies of the APIs are:
-        - Nominatim: maximum 1 request / second 
+        - Nominatim: maximum 1 request / second, measured from the start of each request (nominatim_limiter),
+          not applied to a self-hosted instance (nominatim_url)
         - BAN: maximum 50 requests / second / ip
+        - BAN /search/csv/: files up to 50 Mo, one upload / second is sent by this class (ban_csv_limiter)
+        - BAN /reverse/csv/: same as /search/csv/, shares ban_csv_limiter
+        - BAN-local: no API, offlineBanGeocoder index of the départements imported (AddressSearch.local_ban)
     Please respect these specifications
     """
+    ban_csv_limiter = rateLimiter(max_calls=1, period=1)
+    cache = None #geocodingCache checked before any request when set (done by the plugin at start), None disables the cache
+    local_ban = None #offlineBanGeocoder answering the 'BAN-local' searches, see get_local_ban()
+    local_ban_path = None #SQLite file of the offline BAN index (set by the plugin at start), only opened when the index is used
+    nominatim_public_url = 'https://nominatim.openstreetmap.org'
+    nominatim_url = None #self-hosted Nominatim (e.g. 'http://localhost:8080') used instead of the public instance, set from the QgsSettings of the plugin
+    nominatim_limiter = rateLimiter(max_calls=1, period=1) #public instance only
+    nominatim_self_hosted_workers = 8 #requests running at the same time on a self-hosted instance
+    ban_csv_max_rows = 5000 #rows of each CSV uploaded by search_addresses_API_BAN_csv(), keeps each upload short enough to be retried
+    ban_csv_max_bytes = 8*1024*1024 #bytes of each CSV uploaded, far below the 50 Mo limit of the endpoint
 
     def __init__(self, api:str, parameters:dict={}):
-        """See search_address_API_BAN() or search_address_nominatim_API() for the parameters"""
+        """See search_address_API_BAN(), search_addresses_API_BAN_csv() or search_address_nominatim_API() for the parameters,
+        'BAN-local' takes the parameters of search_address_API_BAN() (see offlineBanGeocoder.search()),
+        'Nominatim-batch' the parameters of search_addresses_nominatim().
+        Reverse geocoding: see reverse_address_API_BAN() ('BAN-reverse') or reverse_addresses_API_BAN_csv() ('BAN-reverse-csv').
+        The results of 'BAN' and 'Nominatim' are taken from AddressSearch.cache when available."""
         try:
-            if api=='BAN':
-                self.result = AddressSearch.search_address_API_BAN(**parameters)
-            elif api=='Nominatim':
-                self.result = AddressSearch.search_address_nominatim_API(**parameters)  
+            if api=='BAN-csv':
+                self.result = AddressSearch.search_addresses_API_BAN_csv(**parameters)
+            elif api=='BAN-reverse':
+                self.result = AddressSearch.reverse_address_API_BAN(**parameters)
+            elif api=='BAN-reverse-csv':
+                self.result = AddressSearch.reverse_addresses_API_BAN_csv(**parameters)
+            elif api=='Nominatim-batch':
+                self.result = AddressSearch.search_addresses_nominatim(**parameters)
+            elif api=='BAN-local':
+                if AddressSearch.get_local_ban() is None:
+                    raise ValueError("No local BAN index, set AddressSearch.local_ban_path or AddressSearch.local_ban with an offlineBanGeocoder")
+                self.result = AddressSearch.local_ban.search(**parameters)
+            elif api in ['BAN', 'Nominatim']:
+                self.result = AddressSearch.cached_search(api, parameters)
         except Exception as err:
             raise err
+
+    @staticmethod
+    def get_local_ban():
+        """Return the offline BAN index (AddressSearch.local_ban), opened from local_ban_path the first time it is needed
+        so the SQLite file is only created for the users of the offline index. None if no index is set.
+
+        Raises:
+            sqlite3.OperationalError: the SQLite of this python can't hold the index, see offlineBanGeocoder.is_supported().
+        """
+        if AddressSearch.local_ban is None and AddressSearch.local_ban_path is not None:
+            from .Offline_Geocoding_BAN import offlineBanGeocoder #Offline_Geocoding_BAN imports this module
+            AddressSearch.local_ban = offlineBanGeocoder(AddressSearch.local_ban_path)
+        return AddressSearch.local_ban
+
+    @staticmethod
+    def cached_search(api:str, parameters:dict) -> gpd.GeoDataFrame:
+        """Return the result of search_address_API_BAN() ('BAN') or search_address_nominatim_API() ('Nominatim') from AddressSearch.cache,
+        the API is only requested if the normalized address has never been geocoded with the same parameters."""
+        if AddressSearch.cache is not None:
+            result = AddressSearch.cache.get(api, parameters['q'], parameters)
+            if result is not None:
+                return result
+        if api=='BAN':
+            result = AddressSearch.search_address_API_BAN(**parameters)
+        else:
+            result = AddressSearch.search_address_nominatim_API(**parameters)
+        if AddressSearch.cache is not None:
+            AddressSearch.cache.put(api, parameters['q'], parameters, result)
+        return result
     
     @staticmethod
     @decorators.retryRequest(min_wait=1,wait_multiplier=2,max_retries=5,exceptions=(RequestException))
@@ -78,9 +219,203 @@ class AddressSearch:
 
     @staticmethod
     @decorators.retryRequest(min_wait=1,wait_multiplier=2,max_retries=5,exceptions=(RequestException))
-    def search_address_nominatim_API(q:str ,limit:int =10, addressdetails:int =1, extratags:int =1, namedetails:int =1, dedupe:int =1, countrycodes: list =None, layer: list=None, featureType:str =None, exclude_place_ids:list =None, viewbox:str =None, bounded:int =0) -> gpd.GeoDataFrame:
+    @decorators.rateLimit(ban_csv_limiter)
+    def request_API_BAN_csv(csv_data:bytes, columns:list=['q'], citycode:str=None, postcode:str=None) -> pd.DataFrame:
+        """Geocode a CSV file with the bulk endpoint of the API Adresse: https://adresse.data.gouv.fr/outils/api-doc/adresse
+
+        Args:
+            - csv_data (bytes): content of the CSV file (comma separated, utf-8, with a header).
+            - columns (list, optional): columns of the CSV used to build the address searched. Defaults to ['q'].
+            - citycode (str, optional): column of the CSV containing the INSEE code used to filter the results.
+            - postcode (str, optional): column of the CSV containing the postal code used to filter the results.
+
+        Returns: a pd.DataFrame with the input columns followed by the result columns (latitude, longitude, result_label, result_score...).
+        """
+        url='https://api-adresse.data.gouv.fr/search/csv/'
+        payload=[('columns', column) for column in columns]
+        if citycode is not None:
+            payload.append(('citycode', citycode))
+        if postcode is not None:
+            payload.append(('postcode', postcode))
+        call = requests.post(url, data=payload, files={'data': ('addresses.csv', csv_data, 'text/csv')})
+        call.raise_for_status()
+        return pd.read_csv(io.BytesIO(call.content), dtype=str, keep_default_na=False, na_values=[''])
+
+    @staticmethod
+    def search_addresses_API_BAN_csv(addresses:list, citycodes:list=None, postcodes:list=None, max_workers:int=2) -> gpd.GeoDataFrame:
+        """Geocode a list of addresses located in France with the bulk CSV endpoint of the API Adresse instead of one request per address.
+        The addresses are split into CSV files of at most ban_csv_max_rows rows and ban_csv_max_bytes bytes, uploaded
+        by up to max_workers at the same time (the uploads stay within ban_csv_limiter).
+
+        Args:
+            - addresses (list of str): addresses to geocode.
+            - citycodes (list, optional): INSEE code of each address used to filter its result. Defaults to None.
+            - postcodes (list, optional): postal code of each address used to filter its result. Defaults to None.
+            - max_workers (int, optional): maximum number of uploads running at the same time. Defaults to 2.
+
+        Returns: a GeoDataFrame with one row per address in the input order, with the address ('q') and the result columns of the API.
+            The geometry is None when no result was found. The addresses found in AddressSearch.cache are not uploaded.
+        """
+        data = pd.DataFrame({'row_id': np.arange(len(addresses)), 'q': [str(address) if address is not None else '' for address in addresses]})
+        filters = {}
+        if citycodes is not None:
+            data['citycode'] = citycodes
+            filters['citycode'] = 'citycode'
+        if postcodes is not None:
+            data['postcode'] = postcodes
+            filters['postcode'] = 'postcode'
+        cached = []
+        if AddressSearch.cache is not None:
+            keys = [geocodingCache.cache_key('BAN-csv', row['q'], {column: row[column] for column in filters}) for row in data.to_dict('records')]
+            found = AddressSearch.cache.get_many(keys)
+            for row_id, key in enumerate(keys):
+                if key in found:
+                    cached.append(found[key].assign(row_id=row_id))
+            data['cache_key'] = keys
+            data = data[[key not in found for key in keys]]
+        row_bytes = data['q'].str.encode('utf-8').str.len().to_numpy() + 32 #row id, filters, separators and quotes
+        chunks, first = [], 0
+        while first < len(data):
+            last = min(first + AddressSearch.ban_csv_max_rows, len(data))
+            last = max(first + 1, min(last, first + int(np.searchsorted(np.cumsum(row_bytes[first:last]), AddressSearch.ban_csv_max_bytes, side='right'))))
+            chunks.append(data.iloc[first:last].drop(columns='cache_key', errors='ignore').to_csv(index=False).encode('utf-8'))
+            first = last
+        results = usefullTools.runConcurrently(
+            lambda csv_data: AddressSearch.request_API_BAN_csv(csv_data, ['q'], **filters),
+            [(csv_data,) for csv_data in chunks],
+            max_workers)
+        output = gpd.GeoDataFrame(columns=['row_id', 'q', 'geometry'], geometry='geometry', crs="EPSG:4326")
+        if len(results) > 0:
+            output = pd.concat(results, ignore_index=True)
+            output['row_id'] = output['row_id'].astype(int)
+            longitude = pd.to_numeric(output.pop('longitude'), errors='coerce')
+            latitude = pd.to_numeric(output.pop('latitude'), errors='coerce')
+            geometry = gpd.GeoSeries(gpd.points_from_xy(longitude, latitude), crs="EPSG:4326")
+            geometry[longitude.isna() | latitude.isna()] = None
+            output = gpd.GeoDataFrame(output, geometry=geometry)
+            if AddressSearch.cache is not None:
+                keys = dict(zip(data['row_id'], data['cache_key']))
+                features = json.loads(output.drop(columns='row_id').to_json(drop_id=True))['features']
+                AddressSearch.cache.put_many([(keys[row_id], 'BAN-csv', feature['properties']['q'], {'features': [feature]})
+                    for row_id, feature in zip(output['row_id'], features)])
+        output = gpd.GeoDataFrame(pd.concat([output, *cached], ignore_index=True), geometry='geometry', crs="EPSG:4326")
+        return output.sort_values('row_id').drop(columns='row_id').reset_index(drop=True)
+
+    @staticmethod
+    @decorators.retryRequest(min_wait=1,wait_multiplier=2,max_retries=5,exceptions=(RequestException))
+    def reverse_address_API_BAN(lon:float, lat:float, limit:int=1, type_search:str=None) -> gpd.GeoDataFrame:
+        """Search the nearest addresses of a point located in France, using the API Adresse from data.gouv.fr
+        https://adresse.data.gouv.fr/outils/api-doc/adresse
+
+        Args:
+            - lon (float): longitude of the point (EPSG:4326).
+            - lat (float): latitude of the point (EPSG:4326).
+            - limit (int, optional): Maximum number of results. Defaults to 1.
+            - type_search (str, optional): Type of the result. Can be 'housenumber', 'street', 'locality', 'municipality'.
+
+        Returns: a GeoDataFrame object containing the results of the API request, the closest address first.
+
+        Raises:
+            ValueError: no address found around the point, the message is the point 'lon,lat'.
+        """
+        url='https://api-adresse.data.gouv.fr/reverse/'
+        payload = {
+            'lon': lon,
+            'lat': lat,
+            'limit': limit,
+            'type': type_search
+        }
+        call = requests.get(url, params=payload)
+        call.raise_for_status()
+        features = call.json()["features"]
+        if not features:
+            raise ValueError('{},{}'.format(lon, lat))
+        return gpd.GeoDataFrame.from_features(features).set_crs("EPSG:4326")
+
+    @staticmethod
+    @decorators.retryRequest(min_wait=1,wait_multiplier=2,max_retries=5,exceptions=(RequestException))
+    @decorators.rateLimit(ban_csv_limiter)
+    def request_API_BAN_reverse_csv(csv_data:bytes, type_search:str=None) -> pd.DataFrame:
+        """Reverse geocode a CSV file with the bulk endpoint of the API Adresse: https://adresse.data.gouv.fr/outils/api-doc/adresse
+
+        Args:
+            - csv_data (bytes): content of the CSV file (comma separated, utf-8, with a header), with the columns 'lon' and 'lat'.
+            - type_search (str, optional): Type of the result. Can be 'housenumber', 'street', 'locality', 'municipality'.
+
+        Returns: a pd.DataFrame with the input columns followed by the result columns (result_label, result_distance...).
+        """
+        url='https://api-adresse.data.gouv.fr/reverse/csv/'
+        payload=[('type', type_search)] if type_search is not None else []
+        call = requests.post(url, data=payload, files={'data': ('points.csv', csv_data, 'text/csv')})
+        call.raise_for_status()
+        return pd.read_csv(io.BytesIO(call.content), dtype=str, keep_default_na=False, na_values=[''])
+
+    @staticmethod
+    def reverse_addresses_API_BAN_csv(points:gpd.GeoDataFrame, id_column:str=None, type_search:str=None, max_workers:int=2) -> pd.DataFrame:
+        """Reverse geocode the points of a GeoDataFrame with the bulk CSV endpoint of the API Adresse instead of one request per point.
+        The points are split into CSV files of at most ban_csv_max_rows rows, uploaded by up to max_workers at the same time
+        (the uploads stay within ban_csv_limiter).
+
+        Args:
+            - points (gpd.GeoDataFrame): points to reverse geocode, in any crs.
+            - id_column (str, optional): column identifying each point (a feature id), the index of points if None.
+            - type_search (str, optional): Type of the result. Can be 'housenumber', 'street', 'locality', 'municipality'.
+            - max_workers (int, optional): maximum number of uploads running at the same time. Defaults to 2.
+
+        Returns: a pd.DataFrame with one row per point in the input order, with the id ('id' or id_column) and the result columns
+            of the API (result_label, result_distance in meters, result_score...), empty when no address was found around the point.
+        """
+        id_column = id_column if id_column is not None else 'id'
+        coordinates = points.geometry.to_crs("EPSG:4326") if points.crs is not None else points.geometry
+        data = pd.DataFrame({
+            'row_id': np.arange(len(points)),
+            'lon': coordinates.x.round(7).to_numpy(),
+            'lat': coordinates.y.round(7).to_numpy()})
+        chunks = [data.iloc[first:first + AddressSearch.ban_csv_max_rows].to_csv(index=False).encode('utf-8')
+            for first in range(0, len(data), AddressSearch.ban_csv_max_rows)]
+        results = usefullTools.runConcurrently(
+            lambda csv_data: AddressSearch.request_API_BAN_reverse_csv(csv_data, type_search),
+            [(csv_data,) for csv_data in chunks],
+            max_workers)
+        if len(results) == 0:
+            return pd.DataFrame(columns=[id_column])
+        output = pd.concat(results, ignore_index=True).drop(columns=['lon', 'lat'])
+        output['row_id'] = output['row_id'].astype(int)
+        for column in ['result_score', 'result_distance']:
+            if column in output.columns:
+                output[column] = pd.to_numeric(output[column], errors='coerce')
+        output = output.sort_values('row_id').reset_index(drop=True)
+        ids = points[id_column].to_numpy() if id_column in points.columns else points.index.to_numpy()
+        output.insert(0, id_column, ids[output.pop('row_id').to_numpy()])
+        return output
+
+    @staticmethod
+    def deduplicate_addresses(addresses:list) -> tuple:
+        """Group the addresses sharing the same normalized address (see geocodingCache.normalize_address()),
+        so a file repeating the same address is geocoded once per unique address instead of once per row.
+
+        Returns: a tuple of two pd.DataFrame with the columns 'ADDRESS' and 'address_key':
+            - one row per input address, in the input order.
+            - one row per unique normalized address (its first occurrence), the ones to geocode.
+        """
+        rows = pd.DataFrame({'ADDRESS': [str(address) for address in addresses]})
+        raw_addresses = rows['ADDRESS'].drop_duplicates()
+        rows['address_key'] = rows['ADDRESS'].map(dict(zip(raw_addresses, raw_addresses.map(geocodingCache.normalize_address))))
+        return rows, rows.drop_duplicates('address_key').reset_index(drop=True)
+
+    @staticmethod
+    def merge_deduplicated(rows:pd.DataFrame, results:gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """Give the results of the unique addresses (with their 'address_key') back to every row of deduplicate_addresses(),
+        the rows keep their order and their own 'ADDRESS'. The rows without result are not kept."""
+        output = rows.merge(results.drop(columns=['ADDRESS'], errors='ignore'), on='address_key', how='inner').drop(columns='address_key')
+        return gpd.GeoDataFrame(output, geometry=results.geometry.name, crs=results.crs)
+
+    @staticmethod
+    @decorators.retryRequest(min_wait=1,wait_multiplier=2,max_retries=5,exceptions=(RequestException))
+    def search_address_nominatim_API(q:str ,limit:int =10, addressdetails:int =1, extratags:int =1, namedetails:int =1, dedupe:int =1, countrycodes: list =None, layer: list=None, featureType:str =None, exclude_place_ids:list =None, viewbox:str =None, bounded:int =0, polygon_geojson:int =1) -> gpd.GeoDataFrame:
         """Search for an address using the Nominatim API
         https://nominatim.org/release-docs/develop/api/Search/
+        The public instance is paced by nominatim_limiter, a self-hosted instance (nominatim_url) is not.
 
         Args:
             - q (str): a string corresponding to the address to research (amenity-street-city-county-state-country-postal code)
@@ -96,6 +431,7 @@ class AddressSearch:
             - viewbox (str, optional): restrict results to a specific bounding box. Defaults to None. <x1>,<y1>,<x2>,<y2> 
             - bounded (int, optional): when 1, turns the 'viewbox' parameter into a filter parameter, excluding any results outside the viewbox.. Defaults to 0.
             - dedupe (int, optional): remove duplicate results. Defaults to 1.
+            - polygon_geojson (int, optional): return the outline of the results instead of their point. Defaults to 1.
 
         Returns: a GeoDataFrame object containing the results of the API request. 
         """
@@ -107,7 +443,7 @@ class AddressSearch:
             'extratags': extratags,
             'namedetails': namedetails,
             'accept-language': 'en',
-            'polygon_geojson': 1,
+            'polygon_geojson': polygon_geojson,
             'countrycodes':countrycodes,
             'layer':layer,
             'featureType':featureType,
@@ -116,10 +452,12 @@ class AddressSearch:
             'bounded':bounded,
             'dedupe':dedupe
         }
-        url= 'https://nominatim.openstreetmap.org/search'
+        url= '{}/search'.format((AddressSearch.nominatim_url or AddressSearch.nominatim_public_url).rstrip('/'))
         headers = {'User-Agent': 'FelixToolbox/1.0'}
 
         try:
+            if AddressSearch.nominatim_url is None:
+                AddressSearch.nominatim_limiter.wait()
             call = requests.get(url, headers=headers, params=payload)
             call.raise_for_status()
             return gpd.GeoDataFrame.from_features(call.json()["features"]).set_crs("EPSG:4326")
@@ -129,4 +467,35 @@ class AddressSearch:
             else:
                 raise e
         except Exception as error:
-            raise error
\ No newline at end of file
+            raise error
+
+    @staticmethod
+    def search_addresses_nominatim(addresses:list, max_workers:int=None, **parameters) -> gpd.GeoDataFrame:
+        """Geocode a list of addresses with Nominatim, keeping only the point of the first result of each address.
+        The payload is lean by default (no address details, extra tags, names or polygons), see search_address_nominatim_API()
+        for the parameters that can be changed. The requests are sent one by one at 1 request / second on the public
+        instance, and by max_workers at the same time without pacing on a self-hosted instance (nominatim_url).
+        The addresses found in AddressSearch.cache are not requested.
+
+        Args:
+            - addresses (list of str): addresses to geocode.
+            - max_workers (int, optional): requests running at the same time on a self-hosted instance. Defaults to nominatim_self_hosted_workers.
+
+        Returns: a GeoDataFrame with one row per address in the input order, with the address ('q') and the result columns of the API.
+            The geometry is None when no result was found.
+        """
+        payload = {'limit': 1, 'addressdetails': 0, 'extratags': 0, 'namedetails': 0, 'polygon_geojson': 0}
+        payload.update(parameters)
+        def geocode(address:str) -> gpd.GeoDataFrame:
+            try:
+                result = AddressSearch.cached_search('Nominatim', dict(payload, q=address)).head(1)
+            except ValueError: #no result
+                result = gpd.GeoDataFrame()
+            if len(result) == 0:
+                return gpd.GeoDataFrame({'q': [address]}, geometry=[None], crs="EPSG:4326")
+            return result.assign(q=address)
+        workers = 1 if AddressSearch.nominatim_url is None else (max_workers or AddressSearch.nominatim_self_hosted_workers)
+        results = usefullTools.runConcurrently(geocode, [(str(address),) for address in addresses], workers)
+        if len(results) == 0:
+            return gpd.GeoDataFrame(columns=['q', 'geometry'], geometry='geometry', crs="EPSG:4326")
+        return gpd.GeoDataFrame(pd.concat(results, ignore_index=True), geometry='geometry', crs="EPSG:4326")
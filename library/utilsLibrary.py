@@ -1,9 +1,19 @@
+import os
+import sys
 import time
 import functools
+import importlib
+import threading
+import contextlib
+import collections
+import multiprocessing
+import multiprocessing.spawn
 import requests
+import numpy as np
 import geopandas as gpd
-from typing import List
-from shapely.geometry import LineString, Point
+from typing import List, Callable
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from shapely.geometry import LineString
 from requests.exceptions import RequestException
 
 class decorators:
@@ -38,6 +48,50 @@ class decorators:
           return wrapper
       return decorator
 
+  @staticmethod
+  def rateLimit(limiter):
+      """
+      Decorator made to make the function wait for the rateLimiter before each call,
+      to respect the usage policy of an API even if the calls come from several threads.
+      Place it under retryRequest so that every retry is also counted by the limiter.
+
+      Args:
+          limiter (rateLimiter): limiter shared by every function requesting the same API.
+      """
+      def decorator(func):
+          @functools.wraps(func)
+          def wrapper(*args, **kwargs):
+              limiter.wait()
+              return func(*args, **kwargs)
+          return wrapper
+      return decorator
+
+class rateLimiter:
+    """Thread-safe limiter allowing at most max_calls requests to start within any window of 'period' seconds.
+    One instance is shared by every thread requesting the same API so that its usage policy is respected globally."""
+    def __init__(self, max_calls:int, period:float=1.0):
+        """
+        Args:
+            max_calls (int): Maximum number of requests started within a period.
+            period (float, optional): Length of the period in seconds. Defaults to 1.0.
+        """
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = collections.deque() #start time of the requests within the current period
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until a new request can be started without exceeding the limit, and register its start time."""
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.max_calls:
+                    self.calls.append(now)
+                    return
+                time.sleep(self.period - (now - self.calls[0]))
+
 class requestOtherApi:
     """Other functions to requests some API potentially needed for some tools"""
     @staticmethod
@@ -133,9 +187,120 @@ class usefullTools:
         """
         if gdf.crs!="EPSG:4326":
             gdf.to_crs(epsg=4326,inplace=True)
-        return [f"{row.geometry.x},{row.geometry.y}" if all([row.geometry is not None, isinstance(row.geometry, Point)]) else None for index, row in gdf.iterrows()]
+        coordinates = usefullTools.pointCoordinatesArray(gdf)
+        return [None if np.isnan(x) else f"{x},{y}" for x, y in coordinates.tolist()]
 
+    @staticmethod
+    def pointCoordinatesArray(gdf:gpd.GeoDataFrame) -> np.ndarray:
+        """
+        Return the coordinates of the points of a GeoDataFrame as a (n, 2) array in the GeoDataFrame's crs.
+        The rows of the empty, missing or non-point geometries are filled with NaN.
+        """
+        coordinates = np.full((len(gdf), 2), np.nan)
+        isPoint = np.asarray((gdf.geometry.geom_type == 'Point') & ~gdf.geometry.is_empty)
+        coordinates[isPoint, 0] = gdf.geometry[isPoint].x.to_numpy()
+        coordinates[isPoint, 1] = gdf.geometry[isPoint].y.to_numpy()
+        return coordinates
 
+    @staticmethod
+    def optionalImport(module:str, feature:str):
+        """
+        Import a module that only some tools of the plugin need (scipy...), so the plugin still loads without it.
+
+        Args:
+            module (str): name of the module to import, e.g. 'scipy.spatial'.
+            feature (str): what needs the module, used in the error message.
+
+        Returns:
+            module: the imported module.
+
+        Raises:
+            ImportError: the module is not installed, the message tells the user which package to install.
+        """
+        try:
+            return importlib.import_module(module)
+        except ImportError as e:
+            package = module.split('.')[0]
+            raise ImportError("{} needs the python package '{}', install it in the python environment of QGIS (e.g. 'pip install {}' from the OSGeo4W Shell on Windows).".format(feature, package, package)) from e
 
+    @staticmethod
+    def runConcurrently(func:Callable, arguments:list[tuple], maxWorkers:int=1, onBatch:Callable=None, batchSize:int=None, flushInterval:float=1.0) -> list:
+        """
+        Call func(*args) for every tuple of arguments using a pool of maxWorkers threads,
+        made for functions that are waiting for an API most of the time.
+        The rate of the requests has to be limited by the function itself (see decorators.rateLimit).
 
+        Args:
+            func (Callable): function to call.
+            arguments (list[tuple]): list of the positional arguments of each call.
+            maxWorkers (int, optional): maximum number of calls running at the same time. Defaults to 1 (sequential).
+            onBatch (Callable, optional): if set, called from the calling thread (e.g. the QGIS main thread) with the list of the results
+                completed since its previous call, in completion order, every batchSize results, every flushInterval seconds and once at the end.
+                The results are then not kept and an empty list is returned. Defaults to None.
+            batchSize (int, optional): maximum number of results given to each onBatch call. Defaults to None (max(5, 2 * maxWorkers)).
+            flushInterval (float, optional): seconds after the previous onBatch call when the results completed since are given to onBatch, whatever their number. Defaults to 1.0.
 
+        Returns:
+            list: the results in the same order as 'arguments'. The first exception raised by a call is raised again.
+        """
+        sequential = maxWorkers is None or maxWorkers <= 1 or len(arguments) <= 1
+        if onBatch is None and sequential:
+            return [func(*args) for args in arguments]
+        batchSize = batchSize or max(5, 2 * (maxWorkers or 1))
+        batch = []
+        lastFlush = time.monotonic()
+        def flush(force:bool=False):
+            nonlocal batch, lastFlush
+            if batch and (force or len(batch) >= batchSize or time.monotonic() - lastFlush >= flushInterval):
+                onBatch(batch)
+                batch = []
+                lastFlush = time.monotonic()
+        if sequential:
+            for args in arguments:
+                batch.append(func(*args))
+                flush()
+            flush(force=True)
+            return []
+        with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+            futures = [pool.submit(func, *args) for args in arguments]
+            try:
+                if onBatch is None:
+                    return [future.result() for future in futures]
+                pending = set(futures)
+                while pending: #wakes up at least every flushInterval so a waiting batch is displayed even if no other result arrives
+                    done, pending = wait(pending, timeout=max(0.0, flushInterval - (time.monotonic() - lastFlush)) if batch else None, return_when=FIRST_COMPLETED)
+                    batch.extend(future.result() for future in done)
+                    flush()
+                flush(force=True)
+                return []
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    @staticmethod
+    @contextlib.contextmanager
+    def processPoolContext():
+        """
+        Context manager giving a 'spawn' multiprocessing context usable to start a process pool from the plugin,
+        the pool has to be created and closed inside the with block.
+        Inside QGIS, sys.executable is the QGIS binary and not a python interpreter, spawning workers
+        with it would open new QGIS instances. In that case the python interpreter shipped with QGIS
+        is used while the block runs, then the previous executable of multiprocessing is restored so
+        the other plugins are not affected. Gives None if no python interpreter can be found, the caller
+        should then stay on a single process.
+        """
+        context = multiprocessing.get_context('spawn')
+        if os.path.basename(sys.executable).lower().startswith('python'):
+            yield context
+            return
+        for executable in [os.path.join(sys.exec_prefix, 'python.exe'), os.path.join(sys.exec_prefix, 'python3.exe'), os.path.join(sys.exec_prefix, 'bin', 'python3')]:
+            if os.path.isfile(executable):
+                previous = multiprocessing.spawn.get_executable()
+                context.set_executable(executable)
+                try:
+                    yield context
+                finally:
+                    context.set_executable(previous)
+                return
+        yield None
@@ -0,0 +1,44 @@
+"""
+Tests of library/Offline_SIRENE_stock.py, the module is loaded from its file so QGIS is not needed.
+"""
+import os
+import importlib.util
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+spec = importlib.util.spec_from_file_location('Offline_SIRENE_stock', os.path.join(os.path.dirname(__file__), '..', 'library', 'Offline_SIRENE_stock.py'))
+Offline_SIRENE_stock = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(Offline_SIRENE_stock)
+offlineSireneStock = Offline_SIRENE_stock.offlineSireneStock
+
+def test_import_chunks_of_different_cardinality_then_query_bbox(tmp_path):
+    """The last chunk is small (few distinct values) and an optional column is empty in it,
+    the fragments written by each chunk must still be read together."""
+    rng = np.random.default_rng(0)
+    n = 3000
+    stock = pd.DataFrame({
+        'siren': ['{:09d}'.format(i) for i in range(n)],
+        'siret': ['{:09d}00012'.format(i) for i in range(n)],
+        'libelleCommuneEtablissement': ['COMMUNE {}'.format(i) for i in range(n)],
+        'activitePrincipaleEtablissement': rng.choice(['47.11Z', '56.10A', '62.01Z'], n),
+        'etatAdministratifEtablissement': rng.choice(['A', 'F'], n),
+        'enseigne1Etablissement': ['SHOP {}'.format(i) if i < 2990 else None for i in range(n)],
+        'coordonneeLambertAbscisseEtablissement': rng.uniform(600000, 620000, n).round(1),
+        'coordonneeLambertOrdonneeEtablissement': rng.uniform(6500000, 6520000, n).round(1)})
+    stock.to_csv(tmp_path / 'StockEtablissement.csv', index=False)
+    local_stock = offlineSireneStock(str(tmp_path / 'stock'))
+    local_stock.chunksize = 2990 #a second chunk of 10 rows
+    assert local_stock.import_stock(str(tmp_path / 'StockEtablissement.csv')) == n
+
+    champs = ['siren', 'siret', 'libelleCommuneEtablissement', 'enseigne1Etablissement']
+    output = local_stock.establishments_in_bbox(605000, 6505000, 615000, 6515000, champs, ['47'])
+
+    x, y = stock['coordonneeLambertAbscisseEtablissement'], stock['coordonneeLambertOrdonneeEtablissement']
+    expected = stock[x.between(605000, 615000) & y.between(6505000, 6515000)
+        & (stock['etatAdministratifEtablissement'] == 'A') & stock['activitePrincipaleEtablissement'].str.startswith('47')]
+    assert len(output) > 0
+    assert sorted(output['siret']) == sorted(expected['siret'])
+    assert list(output.columns[:len(champs)]) == champs
+    assert output.set_index('siret').loc[expected['siret'], 'libelleCommuneEtablissement'].tolist() == expected['libelleCommuneEtablissement'].tolist()
@@ -9,7 +9,7 @@
  ***************************************************************************/
 """
 from .utils import load_ui, UI_tools
-from ..library import Isochrone_API_ORS, apiSireneRequest
+from ..library import Isochrone_API_ORS, apiSireneRequest, AddressSearch, offlineSireneStock, siretInPolygonFilteredByCoordinates
 from qgis.PyQt import QtWidgets
 from qgis.core import QgsSettings
 
@@ -28,6 +28,8 @@ class ui_mg_api_key(QtWidgets.QDialog, load_ui('API_keys_storage.ui').FORM_CLASS
         self.setupUi(self)
         self.lineEdit_SIRENE_key.setText(UI_tools.read_API_key('SIRENE_API_KEY'))
         self.lineEdit_ORS_key.setText(UI_tools.read_API_key('ORS_API_KEY'))
+        self.lineEdit_Nominatim_url.setText(UI_tools.read_API_key('NOMINATIM_URL'))
+        self.lineEdit_SIRENE_stock.setText(UI_tools.read_API_key('SIRENE_STOCK_DIR'))
         self.pushButton_test_keys.clicked.connect(self.test_api_keys)
 
     @staticmethod
@@ -60,5 +62,10 @@ class ui_run_api_key():
             try:
                 self.dlg.store_api_key('SIRENE_API_KEY', self.dlg.lineEdit_SIRENE_key.text())
                 self.dlg.store_api_key('ORS_API_KEY', self.dlg.lineEdit_ORS_key.text())
+                self.dlg.store_api_key('NOMINATIM_URL', self.dlg.lineEdit_Nominatim_url.text().strip())
+                AddressSearch.nominatim_url = self.dlg.lineEdit_Nominatim_url.text().strip() or None #the public instance when empty
+                self.dlg.store_api_key('SIRENE_STOCK_DIR', self.dlg.lineEdit_SIRENE_stock.text().strip())
+                stock = offlineSireneStock(self.dlg.lineEdit_SIRENE_stock.text().strip())
+                siretInPolygonFilteredByCoordinates.local_stock = stock if stock.exists() else None #the API when no stock was imported
             except Exception as e:
                 raise e
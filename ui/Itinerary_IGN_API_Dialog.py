@@ -11,11 +11,13 @@
         github               : https://github.com/EwStinky/FelixToolbox
  ***************************************************************************/
 """
+import functools
 from .utils import load_ui, prepVector
 from ..library import ItineraireIGN
 from qgis.PyQt import QtWidgets
 from qgis.core import QgsProject, QgsMapLayerType, QgsWkbTypes
-from qgis.core import QgsVectorLayer
+from qgis.core import QgsVectorLayer, QgsApplication
+from qgis.gui import QgsFileWidget
 
 class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FORM_CLASS):
     """ui_mg_itinerary_ign contains all the functions specifically designed to manage the UI
@@ -37,6 +39,7 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
         self.comboBox_processingMode.currentIndexChanged.connect(self.update_processing_mode_parameters)
         self.list_layers = [] 
         self.comboBox_departure.currentIndexChanged.connect(self.refreshKeyLayer)
+        self.gridLayout_isochrone_parameters.addWidget(self.create_performance_parameters(), 5, 0, 1, 4)
         # Hide some parameters because processing mode is 0 at start
         self.spinBox_MaximumTime.hide()
         self.label_MaximumTime.hide()
@@ -65,7 +68,7 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
         It checks if the user has enter parameters in the QlineEdit or QComboBox.
         If not, the missing or wrong input will be highlighted in red
         """
-        if self.comboBox_processingMode.currentIndex()<2:
+        if self.comboBox_processingMode.currentIndex()!=2:
             self.comboBox_departure.setStyleSheet("""QComboBox { }""")
             if self.comboBox_departure.currentText()=="": #Check if the user has selected a layer
                 self.comboBox_departure.setStyleSheet("""
@@ -113,7 +116,15 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
                 'constraints': self.lineEdit_constraint.text(),
                 'maximalTime':self.spinBox_MaximumTime.value() if self.spinBox_MaximumTime.isVisible() else None,
                 'orderColumn':self.comboBox_orderColumn.currentText() if self.comboBox_orderColumn.isVisible() else None,
-                'groupByColumn': self.comboBox_groupByColumn.currentText() if all([self.comboBox_groupByColumn.isVisible(),self.comboBox_groupByColumn.currentText()!='None']) else None
+                'groupByColumn': self.comboBox_groupByColumn.currentText() if all([self.comboBox_groupByColumn.isVisible(),self.comboBox_groupByColumn.currentText()!='None']) else None,
+                'maxWorkers': self.performance_spinBoxWorkers.value(),
+                'chainRequest': self.performance_checkBoxChain.isVisible() and self.performance_checkBoxChain.isChecked(),
+                'maximumSpeed': self.performance_spinBoxSpeed.value() if all([self.performance_spinBoxSpeed.isVisible(),self.performance_spinBoxSpeed.value()>0]) else None,
+                'kNearest': self.performance_spinBoxNearest.value(),
+                'oversampling': self.performance_spinBoxOversampling.value(),
+                'flowOutput': self.performance_checkBoxFlow.isVisible() and self.performance_checkBoxFlow.isChecked(),
+                'flowWeight': self.performance_comboBoxFlowWeight.currentText() if all([self.performance_checkBoxFlow.isVisible(),self.performance_checkBoxFlow.isChecked(),self.performance_comboBoxFlowWeight.currentText() not in ['','None']]) else None,
+                'matrixExport': self.performance_fileWidgetExport.filePath() if all([self.performance_fileWidgetExport.isVisible(),self.performance_fileWidgetExport.filePath()!='']) else None
                 }
             ]
         self.list_layers.append(
@@ -125,6 +136,7 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
         self.comboBox_processingMode.setCurrentIndex(0)
         self.comboBox_orderColumn.setCurrentIndex(-1)
         self.comboBox_key.setCurrentIndex(-1)
+        self.performance_fileWidgetExport.setFilePath('')
         numRows = self.tableWidget.rowCount()
         self.tableWidget.insertRow(numRows) # Create a empty row at bottom of table
         for i in range(len(parameters)): #populate the row
@@ -155,15 +167,83 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
             data.append([self.tableWidget.item(row, col).text() for col in range(self.tableWidget.columnCount())])
         return [data[i:i+columnNumber] for i in range(0,len(data),columnNumber)][0]
 
+    def create_performance_parameters(self):
+        """Creates a QtWidget containing the parameters used to speed up the requests."""
+        self.performance_subWidget = QtWidgets.QWidget()
+        self.performance_subLayout = QtWidgets.QGridLayout()
+        self.performance_subWidget.setLayout(self.performance_subLayout)
+        self.performance_workers_label = QtWidgets.QLabel("Concurrent requests (the geopf.fr limit of 5 requests/second is always respected)")
+        self.performance_subLayout.addWidget(self.performance_workers_label, 0, 0)
+        self.performance_spinBoxWorkers = QtWidgets.QSpinBox()
+        self.performance_spinBoxWorkers.setRange(1, 10)
+        self.performance_spinBoxWorkers.setValue(4)
+        self.performance_subLayout.addWidget(self.performance_spinBoxWorkers, 1, 0)
+        self.performance_checkBoxChain = QtWidgets.QCheckBox("Request each group as one itinerary with intermediate points (fewer requests)")
+        self.performance_subLayout.addWidget(self.performance_checkBoxChain, 1, 1)
+        self.performance_checkBoxChain.hide()
+        self.performance_speed_label = QtWidgets.QLabel("Maximum straight-line speed (km/h) used to discard unreachable arrival points")
+        self.performance_subLayout.addWidget(self.performance_speed_label, 0, 2)
+        self.performance_spinBoxSpeed = QtWidgets.QSpinBox()
+        self.performance_spinBoxSpeed.setRange(0, 300)
+        self.performance_spinBoxSpeed.setSpecialValueText("Default for the displacement mode")
+        self.performance_subLayout.addWidget(self.performance_spinBoxSpeed, 1, 2)
+        self.performance_speed_label.hide()
+        self.performance_spinBoxSpeed.hide()
+        self.performance_nearest_label = QtWidgets.QLabel("Number of nearest arrival points kept (by duration)")
+        self.performance_subLayout.addWidget(self.performance_nearest_label, 0, 3)
+        self.performance_spinBoxNearest = QtWidgets.QSpinBox()
+        self.performance_spinBoxNearest.setRange(1, 100)
+        self.performance_spinBoxNearest.setValue(3)
+        self.performance_subLayout.addWidget(self.performance_spinBoxNearest, 1, 3)
+        self.performance_oversampling_label = QtWidgets.QLabel("Oversampling of the straight-line candidates")
+        self.performance_subLayout.addWidget(self.performance_oversampling_label, 0, 4)
+        self.performance_spinBoxOversampling = QtWidgets.QDoubleSpinBox()
+        self.performance_spinBoxOversampling.setRange(1, 10)
+        self.performance_spinBoxOversampling.setSingleStep(0.5)
+        self.performance_spinBoxOversampling.setValue(2)
+        self.performance_subLayout.addWidget(self.performance_spinBoxOversampling, 1, 4)
+        for widget in [self.performance_nearest_label, self.performance_spinBoxNearest, self.performance_oversampling_label, self.performance_spinBoxOversampling]:
+            widget.hide()
+        self.performance_checkBoxFlow = QtWidgets.QCheckBox("Output the flows on the road segments (count of itineraries) instead of the itineraries")
+        self.performance_subLayout.addWidget(self.performance_checkBoxFlow, 2, 0, 1, 2)
+        self.performance_flowWeight_label = QtWidgets.QLabel("Trip weight field of the departure layer")
+        self.performance_subLayout.addWidget(self.performance_flowWeight_label, 2, 2)
+        self.performance_comboBoxFlowWeight = QtWidgets.QComboBox()
+        self.performance_subLayout.addWidget(self.performance_comboBoxFlowWeight, 2, 3)
+        self.performance_export_label = QtWidgets.QLabel("Export the matrix to a CSV or Parquet file (optional)")
+        self.performance_subLayout.addWidget(self.performance_export_label, 3, 0)
+        self.performance_fileWidgetExport = QgsFileWidget()
+        self.performance_fileWidgetExport.setStorageMode(QgsFileWidget.SaveFile)
+        self.performance_fileWidgetExport.setFilter("CSV (*.csv);;Parquet (*.parquet)")
+        self.performance_subLayout.addWidget(self.performance_fileWidgetExport, 4, 0)
+        self.performance_matrix_label = QtWidgets.QLabel("Matrix table computed before, whose selected pairs are routed")
+        self.performance_subLayout.addWidget(self.performance_matrix_label, 3, 1, 1, 2)
+        self.performance_comboBoxMatrix = QtWidgets.QComboBox()
+        self.performance_subLayout.addWidget(self.performance_comboBoxMatrix, 4, 1, 1, 2)
+        self.performance_pushButtonRoute = QtWidgets.QPushButton("Route the selected pairs")
+        self.performance_subLayout.addWidget(self.performance_pushButtonRoute, 4, 3)
+        for widget in self.matrix_widgets():
+            widget.hide()
+        return self.performance_subWidget
+
+    def matrix_widgets(self) -> list:
+        """Widgets only used by the travel time/distance matrix mode (3)."""
+        return [self.performance_export_label, self.performance_fileWidgetExport, self.performance_matrix_label,
+            self.performance_comboBoxMatrix, self.performance_pushButtonRoute]
+
     def update_processing_mode_parameters(self, index):
         """Update the QGridLayout to show or hide the Voronoi processing mode parameters.
         Also show or hide the key comboBox and label based on the processing mode selected."""
         if index == 1:
             self.spinBox_MaximumTime.show()
             self.label_MaximumTime.show()
+            self.performance_spinBoxSpeed.show()
+            self.performance_speed_label.show()
         else:
             self.spinBox_MaximumTime.hide()
             self.label_MaximumTime.hide()
+            self.performance_spinBoxSpeed.hide()
+            self.performance_speed_label.hide()
             
         if index == 2:
             self.comboBox_orderColumn.show()
@@ -174,6 +254,7 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
             self.label_arrival.hide()
             self.comboBox_key.hide()
             self.comboBox_key_label.hide()
+            self.performance_checkBoxChain.show()
 
         else:
             self.comboBox_orderColumn.hide()
@@ -184,12 +265,21 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
             self.comboBox_arrival.show()
             self.comboBox_key.show()
             self.comboBox_key_label.show()
+            self.performance_checkBoxChain.hide()
+
+        for widget in [self.performance_nearest_label, self.performance_spinBoxNearest, self.performance_oversampling_label, self.performance_spinBoxOversampling]:
+            widget.setVisible(index == 4)
+        for widget in [self.performance_checkBoxFlow, self.performance_flowWeight_label, self.performance_comboBoxFlowWeight]:
+            widget.setVisible(index != 3)
+        for widget in self.matrix_widgets():
+            widget.setVisible(index == 3)
             
     def refreshKeyLayer(self):
         """Refresh some specific comboBoxes depending with the attributes of the layer selected in self.comboBox_departure."""
         self.comboBox_key.clear()
         self.comboBox_orderColumn.clear()
         self.comboBox_groupByColumn.clear()
+        self.performance_comboBoxFlowWeight.clear()
         if self.comboBox_departure.currentText()=="":
             pass
         else:
@@ -202,6 +292,8 @@ class ui_mg_itinerary_ign(QtWidgets.QDialog, load_ui('Itinerary_IGN_API.ui').FOR
                 self.comboBox_orderColumn.addItems(field_names)
                 self.comboBox_groupByColumn.addItem("None") 
                 self.comboBox_groupByColumn.addItems(field_names)
+                self.performance_comboBoxFlowWeight.addItem("None")
+                self.performance_comboBoxFlowWeight.addItems(field_names)
         
 class ui_run_itinerary_ign():
     """ui_run_itinerary_ign is used to run Itinerary_IGN_API's UI.
@@ -210,6 +302,29 @@ class ui_run_itinerary_ign():
     """
     def __init__(self):
         self.dlg = ui_mg_itinerary_ign()
+        self.matrices = {} #id of the matrix table layers added to the project: itineraryMatrix used to route their selected pairs
+        self.dlg.performance_pushButtonRoute.clicked.connect(self.route_selected_pairs)
+
+    @staticmethod
+    def add_batch_to_layer(layer:QgsVectorLayer, batch):
+        """Append a batch of itineraries to the layer displayed since the start of the run and let QGIS refresh the map,
+        so the user sees the itineraries arrive instead of a frozen window."""
+        prepVector.append_dataframe_to_layer(layer, batch)
+        QgsApplication.processEvents()
+
+    def route_selected_pairs(self):
+        """Request the itineraries of the pairs (start_id, end_id) selected in the matrix table chosen in the dialog,
+        see itineraryMatrix.route(), and add them to the project as a new layer."""
+        layer = QgsProject.instance().mapLayer(self.dlg.performance_comboBoxMatrix.currentData())
+        if layer is None or layer.id() not in self.matrices or layer.selectedFeatureCount() == 0:
+            return
+        matrix = self.matrices[layer.id()]
+        start_ids = {str(value): value for value in matrix.startIds} #the ids are written as text in the table layer
+        end_ids = {str(value): value for value in matrix.endIds}
+        pairs = [(start_ids[str(feature['start_id'])], end_ids[str(feature['end_id'])]) for feature in layer.selectedFeatures()]
+        itineraries = matrix.route(pairs, self.dlg.performance_spinBoxWorkers.value())
+        if not itineraries.empty:
+            QgsProject.instance().addMapLayer(QgsVectorLayer(itineraries.to_json(), "Itinerary_IGN_{}".format(layer.name()), "ogr"))
 
     def run(self): 
         self.dlg.comboBox_departure.clear()
@@ -220,6 +335,10 @@ class ui_run_itinerary_ign():
         for layer in QgsProject.instance().mapLayers().values():
                     if layer.type() == QgsMapLayerType.VectorLayer and layer.geometryType() == QgsWkbTypes.PointGeometry:
                         self.dlg.comboBox_arrival.addItem(layer.name(), layer.id())
+        self.matrices = {layer_id: matrix for layer_id, matrix in self.matrices.items() if QgsProject.instance().mapLayer(layer_id) is not None}
+        self.dlg.performance_comboBoxMatrix.clear()
+        for layer_id in self.matrices:
+            self.dlg.performance_comboBoxMatrix.addItem(QgsProject.instance().mapLayer(layer_id).name(), layer_id)
 
         ui=self.dlg.exec()
         if ui == QtWidgets.QDialog.Accepted:
@@ -229,10 +348,28 @@ class ui_run_itinerary_ign():
                     departure_gdf=prepVector.layer_to_geodataframe(departure_layer)
                     departure_gdf=departure_gdf.to_crs('EPSG:4326') if departure_gdf.crs!='EPSG:4326' else departure_gdf
                     parameters=eval(data[3])
-                    if data[2] != 'Sequential point routing from a single layer':
+                    matrix_export=parameters.pop('matrixExport', None)
+                    if int(data[2]) != 2: #Every processing mode except 'Sequential point routing from a single layer' needs an arrival layer
                         arrival_gdf=prepVector.layer_to_geodataframe(QgsProject.instance().mapLayer(self.dlg.list_layers[index][1]))
                         parameters['end'] = arrival_gdf.to_crs('EPSG:4326') if arrival_gdf.crs !='EPSG:4326' else arrival_gdf
+                    if int(data[2]) in [0, 1] and not parameters.get('flowOutput'): #the itineraries are displayed as soon as they are computed
+                        layer=QgsVectorLayer("LineString?crs=EPSG:4326", "Itinerary_IGN_{}".format(departure_layer.name()), "memory")
+                        QgsProject.instance().addMapLayer(layer)
+                        parameters['onBatch'] = functools.partial(self.add_batch_to_layer, layer)
                     itinerary=ItineraireIGN(departure_gdf,int(data[2]),**parameters)
-                    QgsProject.instance().addMapLayer(QgsVectorLayer(itinerary.output, "Itinerary_IGN_{}".format(departure_layer.name()), "ogr"))
+                    if 'onBatch' in parameters:
+                        continue
+                    if int(data[2]) == 3:
+                        matrix_layer=prepVector.dataframe_to_table_layer(itinerary.output, "Itinerary_matrix_IGN_{}".format(departure_layer.name()))
+                        QgsProject.instance().addMapLayer(matrix_layer)
+                        self.matrices[matrix_layer.id()]=itinerary.matrix
+                        if matrix_export is not None and matrix_export.lower().endswith('.parquet'):
+                            itinerary.matrix.to_parquet(matrix_export)
+                        elif matrix_export is not None:
+                            itinerary.matrix.to_csv(matrix_export)
+                    elif parameters.get('flowOutput'):
+                        QgsProject.instance().addMapLayer(QgsVectorLayer(itinerary.output, "Itinerary_flows_IGN_{}".format(departure_layer.name()), "ogr"))
+                    else:
+                        QgsProject.instance().addMapLayer(QgsVectorLayer(itinerary.output, "Itinerary_IGN_{}".format(departure_layer.name()), "ogr"))
             except Exception as e:
                 raise e
\ No newline at end of file
@@ -176,7 +176,7 @@ class ui_run_request_sirene():
                     request_parameters={
                     "api_key":data[1].split()[0], 
                     "champs": data[3],
-                    "nombre": 100,
+                    "nombre": 1000,
                     "curseur": '*',
                     "date": '2099-01-01'
                     }
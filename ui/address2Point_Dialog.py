@@ -10,17 +10,19 @@
         github               : https://github.com/EwStinky/FelixToolbox
  ***************************************************************************/
 """
-from .utils import load_ui, prepVector
-from ..library import AddressSearch
+from .utils import load_ui, prepVector, csvTableModel
+from ..library import AddressSearch, offlineBanGeocoder
 import time
-import csv
+import sqlite3
 import pandas as pd
 import geopandas as gpd
 
 from qgis.PyQt import QtWidgets
 from qgis.PyQt.QtGui import QIntValidator
+from qgis.PyQt.QtCore import Qt
 from qgis.core import QgsProject
-from qgis.core import QgsVectorLayer
+from qgis.core import QgsVectorLayer, QgsMapLayerType, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsCoordinateTransform
+from qgis.core import QgsFeatureRequest, QgsGeometry, QgsPointXY
 
 class ui_mg_address2point(QtWidgets.QDialog, load_ui('Address2Point.ui').FORM_CLASS):
     """ui_mg_address2point contains all the functions specifically designed to manage the UI
@@ -43,18 +45,30 @@ class ui_mg_address2point(QtWidgets.QDialog, load_ui('Address2Point.ui').FORM_CL
         self.pushButton_csv_file_load_Tab2.clicked.connect(self.load_csv)
         self.tabWidget.currentChanged.connect(self.tabChanged)
         self.comboBox_2_csv_encoding_Tab2.currentIndexChanged.connect(self.update_encoding_parameter)
+        self.comboBox_API_selection_Tab2.currentTextChanged.connect(self.check_local_ban)
+        self.comboBox_API_selection_Tab4.currentTextChanged.connect(self.check_local_ban)
+        self.comboBox_layer_Tab4.currentIndexChanged.connect(self.refreshAddressFields)
+        if not offlineBanGeocoder.is_supported():
+            self.disable_local_ban("The offline BAN index needs SQLite >= 3.34 with FTS5, the SQLite of this QGIS is {}.".format(sqlite3.sqlite_version))
         self.onlyInt = QIntValidator()
         self.lineEdit_cityCodes_BAN_Tab1.setValidator(self.onlyInt)
         self.lineEdit_postCode_BAN_Tab1.setValidator(self.onlyInt)
         self.label_encoding_perso_csv_Tab2.hide()
         self.lineEdit_encoding_perso_csv_Tab2.hide()   
+        self.csv_model = None #csvTableModel of the CSV file loaded in the second tab
 
     def tabChanged(self):
         if self.tabWidget.currentIndex()==0:
             self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(self.tableWidget_Tab1.rowCount() > 0)
             self.pushButton_Effacer_ligne_table_Tab1.setEnabled(self.tableWidget_Tab1.rowCount() > 0)
+        elif self.tabWidget.currentIndex()==1:
+            self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(self.csv_model is not None and self.csv_model.rowCount() > 0)
+        elif self.tabWidget.currentIndex()==2:
+            self.refreshPointLayers()
+            self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(self.comboBox_layer_Tab3.count() > 0)
         else:
-            self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(self.tableWidget_Tab2.rowCount() > 0)
+            self.refreshVectorLayers()
+            self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(self.comboBox_layer_Tab4.count() > 0)
 
     #Individual geocoding Tab
     def addRowQTableWidget(self): 
@@ -190,7 +204,7 @@ class ui_mg_address2point(QtWidgets.QDialog, load_ui('Address2Point.ui').FORM_CL
         (Mostly point, but can be polygon with Nominatim).
 
         It will respect the usage policies of the APIs used:
-            - Nominatim: maximum 1 request / second
+            - Nominatim: maximum 1 request / second (AddressSearch.nominatim_limiter)
             - BAN: maximum 50 requests / second / ip (count_BAN)
 
         Args:
@@ -226,8 +240,7 @@ class ui_mg_address2point(QtWidgets.QDialog, load_ui('Address2Point.ui').FORM_CL
                         output_api['API']= 'BAN'
                         output_api['ADDRESS']=parameters['q']
                         output_list.append(output_api)
-                else:
-                    time.sleep(1.2)
+                else: #paced by AddressSearch.nominatim_limiter
                     output_api=AddressSearch(row[1],parameters).result
                     output_api['INDEX']= index
                     output_api['API']= 'Nominatim'
@@ -239,29 +252,23 @@ class ui_mg_address2point(QtWidgets.QDialog, load_ui('Address2Point.ui').FORM_CL
 
     #CSV geocoding Tab
     def load_csv(self):
-        """loads a CSV file and populates the QTableWidget of the UI with the data.
+        """loads a CSV file in the QTableView of the UI through a csvTableModel, only the rows displayed are read from the file.
         it then populate the comboBox with the header of the CSV file to select the address column.
-        Hides the OK and delete buttons if the QTableWidget is empty."""
+        Hides the OK and delete buttons if the file has no rows."""
         
         try:
             file_path = self.mQgsFileWidget_Tab2.filePath()
             if file_path:
                 csv_delimiter = self.comboBox_2_csv_encoding_Tab2.currentText() if self.comboBox_2_csv_encoding_Tab2.currentIndex() != 12 and not self.lineEdit_encoding_perso_csv_Tab2.isVisible() else self.lineEdit_encoding_perso_csv_Tab2.text()
-                with open(file_path, mode='r', encoding=csv_delimiter, newline='') as file:
-                    data = list(csv.reader(file, delimiter='{}'.format(self.lineEdit_csv_delimiter_Tab2.text())))
-                    if not data:
-                        return
-
-                    self.tableWidget_Tab2.setRowCount(len(data) - 1)  # Subtract 1 for the header row
-                    self.tableWidget_Tab2.setColumnCount(len(data[0]))
-                    for row_index, row_data in enumerate(data[1:]):  # Skip the header row
-                        for col_index, cell_data in enumerate(row_data):
-                            self.tableWidget_Tab2.setItem(row_index, col_index, QtWidgets.QTableWidgetItem(cell_data))
-                    self.tableWidget_Tab2.setHorizontalHeaderLabels(data[0])
+                model = csvTableModel(file_path, encoding=csv_delimiter, delimiter='{}'.format(self.lineEdit_csv_delimiter_Tab2.text()), parent=self)
+                if not model.header:
+                    return
+                self.csv_model = model
+                self.tableView_Tab2.setModel(self.csv_model)
 
-                    self.comboBox_address_column_Tab2.clear()
-                    self.comboBox_address_column_Tab2.addItems(data[0])
-                    self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(self.tableWidget_Tab2.rowCount() > 0)
+                self.comboBox_address_column_Tab2.clear()
+                self.comboBox_address_column_Tab2.addItems(self.csv_model.header)
+                self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(self.csv_model.rowCount() > 0)
         except Exception as err:
             QtWidgets.QMessageBox.warning(self, "Warning", f"{err}, try to choose another encoding or to fix your csv file.")
 
@@ -274,21 +281,51 @@ class ui_mg_address2point(QtWidgets.QDialog, load_ui('Address2Point.ui').FORM_CL
             self.label_encoding_perso_csv_Tab2.hide()
             self.lineEdit_encoding_perso_csv_Tab2.hide()
 
-    def getAddressColumn(self):
-        """getAddressColumn returns the index (int) of the address column
-        select by the user in the comboBox_address_column_Tab2
-        """
-        for i in range(self.tableWidget_Tab2.columnCount()):
-            if self.tableWidget_Tab2.horizontalHeaderItem(i).text() == '{}'.format(self.comboBox_address_column_Tab2.currentText()):
-                return i
-        
+    def disable_local_ban(self, message:str):
+        """Grey out the offline BAN index in the API comboBoxes, message is shown as tooltip of the item."""
+        for comboBox in [self.comboBox_API_selection_Tab2, self.comboBox_API_selection_Tab4]:
+            index = comboBox.findText('BAN (offline index)')
+            if index != -1:
+                comboBox.model().item(index).setEnabled(False)
+                comboBox.setItemData(index, message, Qt.ToolTipRole)
+                if comboBox.currentIndex() == index:
+                    comboBox.setCurrentIndex(0)
+
+    def check_local_ban(self, api:str):
+        """When the offline BAN index is selected (api: text of the API comboBox), open it (see AddressSearch.get_local_ban()) and if it is
+        still empty, ask for the départements to download and import in the index (see offlineBanGeocoder.import_departement()),
+        it is only done once per département."""
+        if api != 'BAN (offline index)':
+            return
+        try:
+            local_ban = AddressSearch.get_local_ban()
+        except sqlite3.OperationalError as err:
+            QtWidgets.QMessageBox.warning(self, "Warning", f"The offline BAN index can't be used: {err}")
+            self.disable_local_ban(str(err))
+            return
+        if local_ban is None or local_ban.departements():
+            return
+        codes, ok = QtWidgets.QInputDialog.getText(self, "BAN offline index",
+            "The offline index is empty, départements to import (comma separated, e.g. 33,2A,974):")
+        if not ok:
+            return
+        try:
+            for code in [code.strip() for code in codes.split(',') if code.strip()!='']:
+                local_ban.import_departement(code)
+        except Exception as err:
+            QtWidgets.QMessageBox.warning(self, "Warning", f"Import of the BAN failed: {err}")
+
     def processAPI_Tab2(self):
-        """processApi_Tab2 will use address2point.py functions to geocode individually each row of the QTableWidget.
+        """processApi_Tab2 will use address2point.py functions to geocode each row of the CSV file, the address column is read straight from the file.
         Each row is passed to the AddressSearch class with the API selected by the user. 
 
+        The rows repeating the same normalized address are geocoded once and the result is given back to each of them (see AddressSearch.deduplicate_addresses()).
+        With BAN, the addresses are geocoded together with the bulk CSV endpoint (see AddressSearch.search_addresses_API_BAN_csv()).
+        With the offline BAN index, no API is requested (see offlineBanGeocoder.search()).
         It will respect the usage policies of the APIs used:
-            - Nominatim: maximum 1 request / second
-            - BAN: maximum 50 requests / second / ip (count_BAN)
+            - Nominatim: maximum 1 request / second (AddressSearch.nominatim_limiter), no limit on a self-hosted instance
+            - BAN: CSV files of limited size, maximum 1 upload / second (AddressSearch.ban_csv_limiter)
+            - BAN offline index: no limit
 
         Raises (probably from AddressSearch):
             ValueError: If the API choice is invalid
@@ -297,42 +334,156 @@ class ui_mg_address2point(QtWidgets.QDialog, load_ui('Address2Point.ui').FORM_CL
 
         Yields:
             gpd.GeoDataFrame: the output of the AddressSearch class, 
-            with the input address added to the gdf.
+            with the input address added to the gdf, one row per row of the file.
         """
         try:
-            if self.comboBox_API_selection_Tab2.currentText() == 'BAN (adresse.data.gouv.fr)':
-                count_BAN=0
-                for row in range(self.tableWidget_Tab2.rowCount()):
-                    item = self.tableWidget_Tab2.item(row, self.getAddressColumn())
-                    if item:
-                        count_BAN+=1
-                        if count_BAN > 50:
-                            time.sleep(1)
-                            count_BAN=0
-                            output=AddressSearch('BAN', {'q':item.text(), 'limit':1}).result
-                            output['ADDRESS']= item.text()
-                            yield output
-                        else:
-                            output=AddressSearch('BAN', {'q':item.text(), 'limit':1}).result
-                            output['ADDRESS']= item.text()
-                            yield output
-            else: 
-                for row in range(self.tableWidget_Tab2.rowCount()):
-                    item = self.tableWidget_Tab2.item(row, self.getAddressColumn())
-                    if item is not None:
-                        time.sleep(1.2)
-                        output=AddressSearch('Nominatim', {'q':item.text(), 'limit':1}).result
-                        output['ADDRESS']= item.text()
-                        yield output
+            addresses=[address for address in self.csv_model.read_column(self.comboBox_address_column_Tab2.currentText()) if address.strip()!=''] #read from the file, not from the view
+            rows,unique_addresses=AddressSearch.deduplicate_addresses(addresses)
+            output=ui_mg_address2point.geocode_unique_addresses(self.comboBox_API_selection_Tab2.currentText(), unique_addresses)
+            yield AddressSearch.merge_deduplicated(rows, output)
         except Exception as e:
             raise e
 
+    @staticmethod
+    def geocode_unique_addresses(api:str, unique_addresses:pd.DataFrame) -> gpd.GeoDataFrame:
+        """Geocode the unique addresses of AddressSearch.deduplicate_addresses() with the API selected in the UI (text of the API comboBox),
+        the first result of each address is kept with its 'address_key', the addresses without result are not kept.
+
+        Raises:
+            ValueError: no address was found.
+        """
+        if api in ['BAN (adresse.data.gouv.fr)', 'Nominatim (OpenStreetMap)']: #every address is sent at once to the bulk CSV endpoint, or to the Nominatim batch
+            output=AddressSearch('BAN-csv' if api.startswith('BAN') else 'Nominatim-batch', {'addresses':unique_addresses['ADDRESS'].tolist()}).result
+            output['address_key']=unique_addresses['address_key'].to_numpy()
+            output=output[output.geometry.notna() & ~output.geometry.is_empty]
+            if output.empty: #same warning as the requests one by one, instead of an empty layer
+                raise ValueError(', '.join(unique_addresses['ADDRESS'].head(3)))
+            return output
+        list_output=[]
+        for address,address_key in zip(unique_addresses['ADDRESS'],unique_addresses['address_key']):
+            try:
+                output=AddressSearch('BAN-local', {'q':address, 'limit':1}).result
+            except ValueError: #addresses without result are not added to the layer
+                continue
+            output['address_key']=address_key
+            list_output.append(output)
+        if not list_output:
+            raise ValueError(', '.join(unique_addresses['ADDRESS'].head(3)))
+        return gpd.GeoDataFrame(pd.concat(list_output, ignore_index=True))
+
+    #Reverse geocoding Tab
+    def refreshPointLayers(self):
+        """Fill the layer comboBox of the reverse geocoding tab with the point layers of the project."""
+        self.comboBox_layer_Tab3.clear()
+        for layer in QgsProject.instance().mapLayers().values():
+            if layer.type() == QgsMapLayerType.VectorLayer and layer.geometryType() == QgsWkbTypes.PointGeometry:
+                self.comboBox_layer_Tab3.addItem(layer.name(), layer.id())
+
+    def processAPI_Tab3(self) -> gpd.GeoDataFrame:
+        """processAPI_Tab3 reverse geocodes the points of the layer selected with the bulk CSV endpoint of the BAN
+        (see AddressSearch.reverse_addresses_API_BAN_csv()). The features are read once: their attributes and their point
+        in EPSG:4326, the results are joined back to them by feature id ('feature_id').
+
+        Returns:
+            gpd.GeoDataFrame: one row per feature with a geometry, its attributes followed by the result columns of the API (EPSG:4326).
+        """
+        layer = QgsProject.instance().mapLayer(self.comboBox_layer_Tab3.currentData())
+        transform = QgsCoordinateTransform(layer.crs(), QgsCoordinateReferenceSystem('EPSG:4326'), QgsProject.instance())
+        feature_ids, attributes, x, y = [], [], [], []
+        for feature in layer.getFeatures():
+            if not feature.hasGeometry():
+                continue
+            point = transform.transform(feature.geometry().centroid().asPoint()) #multipoints are reduced to their centroid
+            feature_ids.append(feature.id())
+            attributes.append(feature.attributes())
+            x.append(point.x())
+            y.append(point.y())
+        points = gpd.GeoDataFrame(attributes, columns=layer.fields().names(), geometry=gpd.points_from_xy(x, y), crs="EPSG:4326")
+        points.insert(0, 'feature_id', feature_ids)
+        results = AddressSearch('BAN-reverse-csv', {
+            'points': points,
+            'id_column': 'feature_id',
+            'type_search': self.comboBox_type_Tab3.currentText() if self.comboBox_type_Tab3.currentText() != '' else None}).result
+        return points.merge(results, on='feature_id', how='left')
+
+    #Layer geocoding Tab
+    def refreshVectorLayers(self):
+        """Fill the layer comboBox of the layer geocoding tab with the vector layers of the project (with or without geometry)."""
+        self.comboBox_layer_Tab4.clear()
+        for layer in QgsProject.instance().mapLayers().values():
+            if layer.type() == QgsMapLayerType.VectorLayer:
+                self.comboBox_layer_Tab4.addItem(layer.name(), layer.id())
+
+    def refreshAddressFields(self):
+        """Fill the field comboBox of the layer geocoding tab with the fields of the layer selected."""
+        self.comboBox_field_Tab4.clear()
+        layer = QgsProject.instance().mapLayer(self.comboBox_layer_Tab4.currentData()) if self.comboBox_layer_Tab4.currentData() else None
+        if layer is not None:
+            self.comboBox_field_Tab4.addItems(layer.fields().names())
+
+    def processAPI_Tab4(self) -> tuple:
+        """processAPI_Tab4 geocodes the addresses of a field of the layer selected. Only this attribute is read from the provider
+        (QgsFeatureRequest without geometry), the features are never copied to a widget. The addresses are deduplicated and
+        geocoded like the CSV tab (see geocode_unique_addresses()).
+
+        Returns:
+            tuple: the QgsVectorLayer and a gpd.GeoDataFrame with one row per feature geocoded: 'feature_id', 'ADDRESS' and the result columns of the API.
+        """
+        layer = QgsProject.instance().mapLayer(self.comboBox_layer_Tab4.currentData())
+        field = self.comboBox_field_Tab4.currentText()
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([field], layer.fields())
+        feature_ids, addresses = [], []
+        for feature in layer.getFeatures(request):
+            address = feature[field]
+            if not address or str(address).strip() == '': #NULL values are skipped as well
+                continue
+            feature_ids.append(feature.id())
+            addresses.append(str(address))
+        if not addresses:
+            raise ValueError(field)
+        rows,unique_addresses=AddressSearch.deduplicate_addresses(addresses)
+        rows['feature_id']=feature_ids
+        output=ui_mg_address2point.geocode_unique_addresses(self.comboBox_API_selection_Tab4.currentText(), unique_addresses)
+        return layer, AddressSearch.merge_deduplicated(rows, output)
+
+    @staticmethod
+    def write_results_to_layer(layer: QgsVectorLayer, results: gpd.GeoDataFrame, geometry: bool):
+        """Write the results of processAPI_Tab4() back into the features of the layer geocoded, matched by feature id.
+
+        Args:
+            layer (QgsVectorLayer): layer geocoded.
+            results (gpd.GeoDataFrame): output of processAPI_Tab4().
+            geometry (bool): if True the point found becomes the geometry of the feature (point layers only),
+                otherwise the fields geocoded_label, geocoded_score, geocoded_longitude and geocoded_latitude are added to the layer.
+        """
+        points = results.geometry.representative_point() #Nominatim may return polygons
+        if geometry:
+            transform = QgsCoordinateTransform(QgsCoordinateReferenceSystem('EPSG:4326'), layer.crs(), QgsProject.instance())
+            changes = {}
+            for feature_id, x, y in zip(results['feature_id'], points.x, points.y):
+                point = QgsGeometry.fromPointXY(transform.transform(QgsPointXY(x, y)))
+                if QgsWkbTypes.isMultiType(layer.wkbType()):
+                    point.convertToMultiType()
+                changes[int(feature_id)] = point
+            layer.dataProvider().changeGeometryValues(changes)
+            layer.updateExtents()
+            layer.triggerRepaint()
+        else:
+            label = next((column for column in ['result_label', 'label', 'display_name'] if column in results.columns), None)
+            score = next((column for column in ['result_score', 'score', 'importance'] if column in results.columns), None)
+            prepVector.update_layer_attributes(layer, results['feature_id'].tolist(), pd.DataFrame({
+                'geocoded_label': results[label].astype(str) if label else None,
+                'geocoded_score': pd.to_numeric(results[score], errors='coerce') if score else float('nan'),
+                'geocoded_longitude': points.x.to_numpy(),
+                'geocoded_latitude': points.y.to_numpy()}))
+
 class ui_run_address2point():
     """ui_mg_address2point is used to run address2point's UI.
     Use the data and API selected from the UI to geocode addresses and display them in QGIS.
     It also respects the usage policies of the APIs used:
         - Nominatim: maximum 1 request / second 
         - BAN: maximum 50 requests / second / ip
+        - BAN reverse geocoding: CSV files, maximum 1 upload / second (AddressSearch.ban_csv_limiter)
     """
     def __init__(self):
         self.dlg = ui_mg_address2point()
@@ -363,8 +514,8 @@ class ui_run_address2point():
                             layer_name = '{}_{}'.format(self.dlg.lineEdit_Output_Name.text(),gdf.geom_type.unique()[0])
                             layer = QgsVectorLayer(gdf.to_json(), layer_name, 'ogr')
                             QgsProject.instance().addMapLayer(layer)
-                else: #CSV file geocoding
-                    if self.dlg.tableWidget_Tab2.rowCount()==0:
+                elif self.dlg.tabWidget.currentIndex()==1: #CSV file geocoding
+                    if self.dlg.csv_model is None or self.dlg.csv_model.rowCount()==0:
                         QtWidgets.QMessageBox.warning(self.dlg, "Warning", "Please load your CSV file.")
                         return
                     else:
@@ -373,6 +524,29 @@ class ui_run_address2point():
                             layer_name = '{}_{}'.format(self.dlg.lineEdit_Output_Name.text(),gdf.geom_type.unique()[0])
                             layer = QgsVectorLayer(gdf.to_json(), layer_name, 'ogr')
                             QgsProject.instance().addMapLayer(layer)
+                elif self.dlg.tabWidget.currentIndex()==2: #Reverse geocoding
+                    if self.dlg.comboBox_layer_Tab3.count()==0:
+                        QtWidgets.QMessageBox.warning(self.dlg, "Warning", "Please add a point layer to the project.")
+                        return
+                    else:
+                        output=self.dlg.processAPI_Tab3()
+                        layer = QgsVectorLayer("Point?crs=EPSG:4326", '{}_reverse'.format(self.dlg.lineEdit_Output_Name.text()), "memory")
+                        prepVector.append_dataframe_to_layer(layer, output)
+                        QgsProject.instance().addMapLayer(layer)
+                else: #Layer geocoding
+                    if self.dlg.comboBox_layer_Tab4.count()==0 or self.dlg.comboBox_field_Tab4.currentText()=='':
+                        QtWidgets.QMessageBox.warning(self.dlg, "Warning", "Please select a layer and its address field.")
+                        return
+                    layer,output=self.dlg.processAPI_Tab4()
+                    if self.dlg.comboBox_output_Tab4.currentIndex()==0: #new point layer, joinable to the layer with 'feature_id'
+                        for gdf in prepVector.separate_gdf_by_geometry(output):
+                            layer_name = '{}_{}'.format(self.dlg.lineEdit_Output_Name.text(),gdf.geom_type.unique()[0])
+                            QgsProject.instance().addMapLayer(QgsVectorLayer(gdf.to_json(), layer_name, 'ogr'))
+                    elif self.dlg.comboBox_output_Tab4.currentIndex()==2 and layer.geometryType() != QgsWkbTypes.PointGeometry:
+                        QtWidgets.QMessageBox.warning(self.dlg, "Warning", "Only the geometry of a point layer can be updated.")
+                        return
+                    else:
+                        ui_mg_address2point.write_results_to_layer(layer, output, self.dlg.comboBox_output_Tab4.currentIndex()==2)
             except ValueError as e:
                 QtWidgets.QMessageBox.warning(self.dlg, "Warning", f"No result for '{e}', try with more details, change the parameters or try another API.")
             except Exception as e:
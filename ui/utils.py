@@ -8,12 +8,17 @@
         github               : https://github.com/EwStinky/FelixToolbox
  ***************************************************************************/
 """
+import io
 import os
+import csv
+import collections
+import numpy as np
 import geopandas as gpd
 import pandas as pd
 
 from qgis.PyQt import uic
-from qgis.core import QgsVectorLayer, QgsSettings
+from qgis.PyQt.QtCore import QVariant, Qt, QAbstractTableModel, QModelIndex
+from qgis.core import QgsVectorLayer, QgsSettings, QgsField, QgsFeature, QgsGeometry
 
 class load_ui():
     """
@@ -76,21 +81,184 @@ class prepVector():
 
         Returns:
             output_list: list of gpd.GeoDataFrame objects, each containing
-            a unique type of geometry.
+            a unique type of geometry, with the dtypes and crs of the input.
+            The rows without geometry are not kept.
         """
-        geometry_dict = {}
-        output_list = []
-        for index, row in gdf.iterrows():
-            if row['geometry'].geom_type not in geometry_dict:
-                geometry_dict[row['geometry'].geom_type] = gpd.GeoDataFrame(columns=gdf.columns, crs=gdf.crs)
-            geometry_dict[row['geometry'].geom_type] = pd.concat(
-                [geometry_dict[row['geometry'].geom_type], row.to_frame().T],
-                ignore_index=True
-            )
-        for y in range(len(geometry_dict)):
-            output_list.append(geometry_dict[list(geometry_dict.keys())[y]])
-        return output_list
+        gdf = gpd.GeoDataFrame(gdf, geometry='geometry', crs=getattr(gdf, 'crs', None))
+        return [gpd.GeoDataFrame(group.reset_index(drop=True), geometry='geometry', crs=gdf.crs)
+            for _, group in gdf.groupby(gdf.geom_type.to_numpy(), sort=False)] #one gdf per geometry type, in order of first appearance
     
+    @staticmethod
+    def dataframe_to_table_layer(df: pd.DataFrame, layer_name:str) -> QgsVectorLayer:
+        """Create a QGIS table layer (memory layer without geometry) from a pd.DataFrame.
+        Integer and float columns are stored as numeric fields, every other column as text.
+
+        Args:
+            df (pd.DataFrame): DataFrame to convert.
+            layer_name (str): name of the layer in QGIS.
+
+        Returns:
+            QgsVectorLayer: the table layer, not yet added to the project.
+        """
+        layer = QgsVectorLayer("None", layer_name, "memory")
+        prepVector.append_dataframe_to_layer(layer, df)
+        return layer
+
+    @staticmethod
+    def add_dataframe_fields(layer: QgsVectorLayer, df: pd.DataFrame) -> list:
+        """Add the columns of a pd.DataFrame missing from a layer as new fields: integer and float columns as numeric fields,
+        every other column as text. Returns the index of the field of each column."""
+        fields = []
+        for column, dtype in df.dtypes.items():
+            if layer.fields().indexOf(str(column)) != -1:
+                continue
+            if pd.api.types.is_integer_dtype(dtype):
+                fields.append(QgsField(str(column), QVariant.LongLong))
+            elif pd.api.types.is_float_dtype(dtype):
+                fields.append(QgsField(str(column), QVariant.Double))
+            else:
+                fields.append(QgsField(str(column), QVariant.String))
+        if fields:
+            layer.dataProvider().addAttributes(fields)
+            layer.updateFields()
+        return [layer.fields().indexOf(str(column)) for column in df.columns]
+
+    @staticmethod
+    def field_value(layer: QgsVectorLayer, position: int, value):
+        """Convert a value of a pd.DataFrame to the type of the field of the layer at position (numpy scalars to python ones)."""
+        if layer.fields().at(position).type() == QVariant.String:
+            return str(value)
+        return value.item() if hasattr(value, 'item') else value
+
+    @staticmethod
+    def update_layer_attributes(layer: QgsVectorLayer, feature_ids: list, df: pd.DataFrame):
+        """Write the columns of a pd.DataFrame into existing features of a layer, the row i going to the feature feature_ids[i].
+        The columns missing from the layer are added as fields first (see add_dataframe_fields()), the changes are written
+        through the data provider, without loading the features.
+
+        Args:
+            layer (QgsVectorLayer): layer to update, its provider must allow to add fields and change attribute values.
+            feature_ids (list): id of the feature of each row.
+            df (pd.DataFrame): values to write, None/NaN values are written as NULL.
+        """
+        positions = prepVector.add_dataframe_fields(layer, df)
+        changes = {}
+        for feature_id, values in zip(feature_ids, df.astype(object).where(df.notna(), None).itertuples(index=False)):
+            changes[int(feature_id)] = {position: (prepVector.field_value(layer, position, value) if value is not None else None)
+                for value, position in zip(values, positions)}
+        layer.dataProvider().changeAttributeValues(changes)
+        layer.triggerRepaint()
+
+    @staticmethod
+    def append_dataframe_to_layer(layer: QgsVectorLayer, df: pd.DataFrame):
+        """Add the rows of a pd.DataFrame (or gpd.GeoDataFrame, in the crs of the layer) as new features of an existing layer.
+        The columns missing from the layer are added as fields first: integer and float columns as numeric fields, 
+        every other column as text. Used to fill a layer already displayed in QGIS batch after batch.
+
+        Args:
+            layer (QgsVectorLayer): editable layer, usually a memory layer.
+            df (pd.DataFrame): rows to add, the geometry column of a GeoDataFrame is used as geometry of the features.
+        """
+        geometries = df.geometry.to_wkb().tolist() if isinstance(df, gpd.GeoDataFrame) else [None] * len(df)
+        df = pd.DataFrame(df.drop(columns=df.geometry.name) if isinstance(df, gpd.GeoDataFrame) else df)
+        positions = prepVector.add_dataframe_fields(layer, df)
+        features = []
+        for values, geometry in zip(df.astype(object).where(df.notna(), None).itertuples(index=False), geometries):
+            feature = QgsFeature(layer.fields())
+            attributes = [None] * layer.fields().count()
+            for value, position in zip(values, positions):
+                if value is not None:
+                    attributes[position] = prepVector.field_value(layer, position, value)
+            feature.setAttributes(attributes)
+            if geometry is not None:
+                geometry_qgis = QgsGeometry()
+                geometry_qgis.fromWkb(geometry)
+                feature.setGeometry(geometry_qgis)
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        layer.updateExtents()
+        layer.triggerRepaint()
+
+class csvTableModel(QAbstractTableModel):
+    """
+    Read-only Qt model of a CSV file for a QTableView, made for files of millions of rows.
+    The file is not loaded: the byte offset of each row is indexed once (newlines outside of quotes),
+    then only the pages of rows displayed by the view are read and parsed, the last max_pages pages are kept in memory.
+    The byte index works with the ASCII compatible encodings (utf-8, latin-1, cp1252...), not with utf-16/32.
+    """
+    def __init__(self, path:str, encoding:str='utf-8', delimiter:str=',', page_size:int=1000, max_pages:int=20, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = collections.OrderedDict()
+        self.offsets = csvTableModel.index_rows(path)
+        with open(path, mode='rb') as file:
+            header = file.read(int(self.offsets[1]) if len(self.offsets) > 1 else -1)
+        self.header = next(csv.reader(io.StringIO(header.decode(encoding)), delimiter=delimiter), [])
+
+    @staticmethod
+    def index_rows(path:str, block_size:int=16*1024*1024) -> np.ndarray:
+        """Return the byte offset of the start of each row of the CSV file (header included) followed by the size of the file.
+        A newline starts a new row only if an even number of quotes precedes it, so quoted multi-line cells stay in one row."""
+        offsets = [np.zeros(1, dtype=np.int64)]
+        parity, position = 0, 0
+        with open(path, mode='rb') as file:
+            while True:
+                block = np.frombuffer(file.read(block_size), dtype=np.uint8)
+                if len(block) == 0:
+                    break
+                quotes = block == ord('"')
+                outside = (np.cumsum(quotes) + parity) % 2 == 0
+                offsets.append(position + np.flatnonzero((block == ord('\n')) & outside).astype(np.int64) + 1)
+                parity = (parity + int(quotes.sum())) % 2
+                position += len(block)
+        offsets = np.concatenate(offsets)
+        if offsets[-1] != position: #last row without final newline
+            offsets = np.append(offsets, position)
+        return offsets
+
+    def page(self, number:int) -> list:
+        """Return the parsed rows of a page, read from the file if the page is not in memory."""
+        if number in self.pages:
+            self.pages.move_to_end(number)
+            return self.pages[number]
+        first = 1 + number * self.page_size #the header is the first row of the index
+        last = min(first + self.page_size, len(self.offsets) - 1)
+        with open(self.path, mode='rb') as file:
+            file.seek(int(self.offsets[first]))
+            data = file.read(int(self.offsets[last] - self.offsets[first]))
+        self.pages[number] = list(csv.reader(io.StringIO(data.decode(self.encoding)), delimiter=self.delimiter))
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return self.pages[number]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else max(len(self.offsets) - 2, 0)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.header)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        page = self.page(index.row() // self.page_size)
+        row = page[index.row() % self.page_size] if index.row() % self.page_size < len(page) else []
+        return row[index.column()] if index.column() < len(row) else None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.header[section] if section < len(self.header) else None
+        return section + 1
+
+    def read_column(self, column:str) -> list:
+        """Read the values of one column straight from the file, with pandas, without going through the model."""
+        return pd.read_csv(self.path, usecols=[column], sep=self.delimiter, encoding=self.encoding, dtype=str, keep_default_na=False)[column].tolist()
+
 class usefullVariable:
     """Class that stores variables that can be imported for other scripts"""
 